@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmarks/controlfile_bench.py - time parsing a Sources file
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the line-based parser with openMapped on a Sources file.
+
+Give it a real Sources file, optionally compressed, such as one from a
+Debian mirror's dists/sid/main/source directory; without one a file of
+similar shape is made up.  Both parsers are run over it, with all fields
+and with only momlib.SOURCES_FIELDS, and their results checked to be
+identical.
+"""
+
+from __future__ import print_function, with_statement
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deb.controlfile import ControlFile, open_file
+from momlib import SOURCES_FIELDS
+
+
+def make_sources(filename, packages):
+    """Write a made up Sources file with the given number of packages."""
+    rand = random.Random(20081006)
+    with open(filename, "w") as sources:
+        for i in range(packages):
+            package = "pkg%d" % i
+            version = "%d.%d-%d" % (rand.randint(0, 9), rand.randint(0, 99),
+                                    rand.randint(1, 5))
+            binaries = [ "%s-bin%d" % (package, j)
+                         for j in range(rand.randint(1, 8)) ]
+            files = [ "%s_%s.dsc" % (package, version),
+                      "%s_%s.orig.tar.gz" % (package, version) ]
+
+            sources.write("Package: %s\n" % package)
+            sources.write("Binary: %s\n" % ", ".join(binaries))
+            sources.write("Version: %s\n" % version)
+            sources.write("Maintainer: Someone <someone@example.org>\n")
+            sources.write("Build-Depends: debhelper (>= 9), libfoo-dev,\n"
+                          " libbar-dev (>= 1.2)\n")
+            sources.write("Architecture: any\nStandards-Version: 3.9.6\n"
+                          "Format: 3.0 (quilt)\n")
+            sources.write("Files:\n")
+            for name in files:
+                sources.write(" %032x %d %s\n"
+                              % (rand.getrandbits(128),
+                                 rand.randint(1000, 1000000), name))
+            sources.write("Checksums-Sha256:\n")
+            for name in files:
+                sources.write(" %064x %d %s\n"
+                              % (rand.getrandbits(256),
+                                 rand.randint(1000, 1000000), name))
+            sources.write("Package-List: \n")
+            for binary in binaries:
+                sources.write(" %s deb misc optional arch=any\n" % binary)
+            sources.write("Homepage: http://example.org/%s\n" % package)
+            sources.write("Directory: pool/main/p/%s\n" % package)
+            sources.write("Priority: source\nSection: misc\n\n")
+
+def best_time(repeat, func, *args):
+    """Return the fastest of repeat calls to func, and its last result."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return (best, result)
+
+def parse_lines(filename, fields):
+    with open(filename) as sources:
+        return ControlFile(fileobj=sources, multi_para=True, signed=False,
+                           fields=fields).paras
+
+def parse_mapped(filename, fields):
+    control = ControlFile()
+    control.openMapped(filename, fields=fields)
+    return control.paras
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [SOURCES]",
+                          description="time parsing a Sources file")
+    parser.add_option("-n", "--repeat", type="int", default=3,
+                      help="Number of times to run each parser [default: 3]")
+    parser.add_option("-p", "--packages", type="int", default=30000,
+                      help="Size of a made up file [default: 30000]")
+    (options, args) = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "Sources")
+        if len(args):
+            # openMapped needs the file uncompressed
+            source = open_file(args[0])
+            try:
+                with open(filename, "wb") as output:
+                    shutil.copyfileobj(source, output)
+            finally:
+                source.close()
+        else:
+            make_sources(filename, options.packages)
+
+        print("%s: %.1f MB" % (args[0] if len(args) else "made up",
+                               os.path.getsize(filename) / 1048576.0))
+
+        identical = True
+        for name, fields in (("all fields", None),
+                             ("SOURCES_FIELDS", SOURCES_FIELDS)):
+            (lines, expected) = best_time(options.repeat, parse_lines,
+                                          filename, fields)
+            (mapped, paras) = best_time(options.repeat, parse_mapped,
+                                        filename, fields)
+            same = (paras == expected)
+            identical = identical and same
+
+            print("%-15s %6d paras  lines %6.2fs  mapped %6.2fs  (%4.1fx)  %s"
+                  % (name, len(expected), lines, mapped, lines / mapped,
+                     "identical" if same else "DIFFERENT"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return 0 if identical else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
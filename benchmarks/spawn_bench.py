@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmarks/spawn_bench.py - time starting processes as we grow
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the latency of forking and spawning against our own size.
+
+The process is grown to each of the given sizes with many small
+dictionaries, like the parsed Sources files produce-merges holds, and
+at each size util.shell is timed running "true" both with posix_spawnp
+and with it disabled so that the child is forked.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import resource
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import shell
+
+
+def maxrss():
+    """Return our maximum resident set size so far, in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def grow(ballast, size):
+    """Add to ballast until we're at least size MiB."""
+    while maxrss() < size:
+        start = len(ballast)
+        ballast.extend({ "Package": "pkg%d" % i, "Version": "1.%d-1" % i }
+                       for i in range(start, start + 10000))
+
+def time_runs(count):
+    """Return the mean time to run "true" count times, in milliseconds."""
+    start = time.time()
+    for i in range(count):
+        shell.run(("true",))
+    return (time.time() - start) * 1000 / count
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          description="time starting processes as we grow")
+    parser.add_option("-c", "--count", type="int", default=200,
+                      help="Number of processes to time [default: 200]")
+    parser.add_option("-s", "--sizes", type="string",
+                      default="0,100,400,1000",
+                      help="Comma-separated sizes to grow to, in MiB "
+                      "[default: 0,100,400,1000]")
+    (options, args) = parser.parse_args()
+
+    posix_spawnp = shell._posix_spawnp
+    if posix_spawnp is None:
+        print("posix_spawnp isn't available, only forking", file=sys.stderr)
+
+    ballast = []
+    for size in sorted(int(size) for size in options.sizes.split(",")):
+        grow(ballast, size)
+
+        shell._posix_spawnp = None
+        try:
+            forked = time_runs(options.count)
+        finally:
+            shell._posix_spawnp = posix_spawnp
+
+        if posix_spawnp is not None:
+            spawned = time_runs(options.count)
+            print("%5d MiB  fork %7.2f ms  spawn %7.2f ms  (%5.1fx)"
+                  % (maxrss(), forked, spawned, forked / spawned))
+        else:
+            print("%5d MiB  fork %7.2f ms" % (maxrss(), forked))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
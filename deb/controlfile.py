@@ -19,6 +19,25 @@
 
 from __future__ import with_statement
 
+import os
+import re
+import gzip
+import mmap
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# Tokens of a multi-paragraph file without comments or signatures: either
+# a run of blank lines, or a field with any continuation lines
+TOKEN_RE = re.compile(r'((?:[ \t\r\f\v]*\n)+)'
+                      r'|([^\s:#][^\s:]*[ \t\r\f\v]*):'
+                      r'([^\n]*(?:\n[ \t\r\f\v]+\S[^\n]*)*)(?:\n|\Z)')
+
 class ControlFile(object):
     """Debian control file.
 
@@ -40,6 +59,7 @@ class ControlFile(object):
         self.paras = []
         self.para = None
         self.signed = False
+        self._fields = {}
 
         if fileobj is not None:
             self.parse(fileobj, *args, **kwds)
@@ -55,12 +75,25 @@ class ControlFile(object):
 
         This can be overriden by adding the canonical capitalisation
         of a field name to the FieldNames list.
+
+        Results are remembered, so each distinct spelling of a field
+        name is only worked out once and every paragraph shares the
+        same interned key string.
         """
+        try:
+            return self._fields[field]
+        except KeyError:
+            pass
+
         for canon in self.FieldNames:
             if canon.lower() == field.lower():
-                return canon
+                break
+        else:
+            canon = "-".join([ w.title() for w in field.split("-") ])
 
-        return "-".join([ w.title() for w in field.split("-") ])
+        canon = intern(canon)
+        self._fields[field] = canon
+        return canon
 
     def open(self, file, *args, **kwds):
         """Open and parse a control-file format file."""
@@ -71,7 +104,93 @@ class ControlFile(object):
                 e.path = file
                 raise e
 
-    def parse(self, file, multi_para=False, signed=False):
+    def openMapped(self, file, fields=None):
+        """Open and parse a multi-paragraph file by mapping it into memory.
+
+        This is a faster alternative to open for large unsigned files
+        like Sources: instead of looping over each line, the whole file
+        is tokenised with a single regular expression.  Files that
+        contain anything the tokeniser doesn't expect, such as comments
+        or PGP signatures, are handed to the line-based parser instead
+        so the result is always the same as open with multi_para=True.
+
+        See iterParse for the fields argument.
+        """
+        with open(file) as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            else:
+                buf = ""
+
+            try:
+                paras = self.tokenise(buf, fields)
+            finally:
+                if size:
+                    buf.close()
+
+        if paras is None:
+            self.open(file, multi_para=True, signed=False, fields=fields)
+        else:
+            self.paras.extend(paras)
+            if len(self.paras):
+                self.para = self.paras[-1]
+            else:
+                self.para = {}
+
+    def tokenise(self, buf, fields=None):
+        """Split a buffer holding a multi-paragraph file into paragraphs.
+
+        Returns the list of paragraphs, or None if the buffer holds
+        anything other than fields and blank lines.  See iterParse for
+        the fields argument.
+        """
+        if fields is not None:
+            fields = frozenset(fields)
+
+        names = self._fields
+        paras = []
+        para = None
+        pos = 0
+
+        match = TOKEN_RE.scanner(buf).match
+        token = match()
+        while token is not None:
+            pos = token.end()
+
+            (blank, field, value) = token.groups()
+            if blank is not None:
+                if para is not None:
+                    paras.append(para)
+                    para = None
+            else:
+                if para is None:
+                    para = {}
+
+                try:
+                    field = names[field]
+                except KeyError:
+                    field = self.capitaliseField(field)
+
+                if fields is not None and field not in fields:
+                    pass
+                elif "\n" in value:
+                    para[field] = "\n".join([ l.strip()
+                                              for l in value.split("\n") ])
+                else:
+                    para[field] = value.strip()
+
+            token = match()
+
+        if len(buf[pos:].strip()):
+            return None
+
+        if para is not None:
+            paras.append(para)
+
+        return paras
+
+    def parse(self, file, multi_para=False, signed=False, fields=None):
         """Parse a control-file format file.
 
         File is any object that acts as an iterator and returns lines,
@@ -83,8 +202,49 @@ class ControlFile(object):
         Some single-paragraph control files may be PGP signed, if this
         is the case set signed to True.  If the file was actually
         signed, the signed member of the object will be set to True.
+
+        See iterParse for the fields argument.
         """
         self.para = {}
+        for para in self.iterParse(file, multi_para, signed, fields):
+            self.paras.append(para)
+            self.para = para
+
+    def iterOpen(self, file, *args, **kwds):
+        """Open a control-file format file and iterate its paragraphs.
+
+        The file may be compressed with gzip or xz, which is recognised
+        from the filename.  See iterParse for the arguments.
+        """
+        f = open_file(file)
+        try:
+            try:
+                for para in self.iterParse(f, *args, **kwds):
+                    yield para
+            except Exception, e:
+                e.path = file
+                raise e
+        finally:
+            f.close()
+
+    def iterParse(self, file, multi_para=True, signed=False, fields=None):
+        """Iterate the paragraphs of a control-file format file.
+
+        Paragraphs are yielded as dictionaries as soon as they have
+        been read, rather than being collected into the paras list, so
+        a multi-paragraph file such as Sources can be processed in
+        constant memory.  Arguments are as for parse, except that
+        multi_para defaults to True.
+
+        If fields is given, only the fields named in it (with their
+        canonical capitalisation) are kept in each paragraph and the
+        rest are thrown away as they are read; most users of a Sources
+        file only need a handful of its fields.
+        """
+        if fields is not None:
+            fields = frozenset(fields)
+
+        para = {}
         is_signed = False
         last_field = None
         para_border = True
@@ -103,7 +263,8 @@ class ControlFile(object):
                 if last_field is None:
                     raise IOError
 
-                self.para[last_field] += "\n" + line.lstrip()
+                if last_field in para:
+                    para[last_field] += "\n" + line.lstrip()
 
             elif ":" in line:
                 (field, value) = line.split(":", 1)
@@ -111,7 +272,8 @@ class ControlFile(object):
                     raise IOError
 
                 last_field = self.capitaliseField(field)
-                self.para[last_field] = value.lstrip()
+                if fields is None or last_field in fields:
+                    para[last_field] = value.lstrip()
 
             elif line.startswith("-----BEGIN PGP") and signed:
                 if is_signed:
@@ -123,8 +285,8 @@ class ControlFile(object):
             elif not len(line):
                 para_border = True
                 if multi_para:
-                    self.paras.append(self.para)
-                    self.para = {}
+                    yield para
+                    para = {}
                     last_field = None
 
                 elif is_signed:
@@ -151,6 +313,20 @@ class ControlFile(object):
             raise IOError
 
         if last_field:
-            self.paras.append(self.para)
-        elif len(self.paras):
-            self.para = self.paras[-1]
+            yield para
+
+
+def open_file(filename):
+    """Open a possibly compressed file for reading.
+
+    Files ending in .gz or .xz are decompressed on the fly, anything
+    else is opened as it is.
+    """
+    if filename.endswith(".gz"):
+        return gzip.GzipFile(filename)
+    elif filename.endswith(".xz"):
+        if lzma is None:
+            raise IOError, "no xz support available for %s" % filename
+        return lzma.LZMAFile(filename)
+    else:
+        return open(filename)
@@ -18,6 +18,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import string
+import struct
 
 
 # Regular expressions make validating things easy
@@ -29,6 +31,21 @@ valid_revision = re.compile(r'^[A-Za-z0-9+.~]+$')
 cmp_table = "~ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+-.:"
 
 
+# Translation of characters in the non-digit parts of a version into
+# bytes that sort in the same order; "~" sorts before the end of a part,
+# which is marked with "\x02", and everything else after it
+cmp_trans = string.maketrans("~" + cmp_table[1:],
+                             "".join([ chr(i) for i in [ 1 ] +
+                                       range(3, len(cmp_table) + 2) ]))
+
+# Splits a version part into alternating non-digit and digit runs
+part_re = re.compile(r'(\D*)(\d*)')
+
+# Number of parsed versions and components kept for re-use
+CACHE_SIZE = 50000
+key_cache = {}
+
+
 class Version(object):
     """Debian version number.
 
@@ -40,19 +57,46 @@ class Version(object):
     The comparison will be done according to Debian rules, so '1.2' will
     compare lower.
 
+    Version strings are only parsed once: constructing a Version from
+    a string that was recently parsed, or from another Version, returns
+    the existing object, so instances must be treated as immutable.
+
     Properties:
       epoch       Epoch
       upstream    Upstream version
       revision    Debian/local revision
     """
 
-    def __init__(self, ver):
+    __slots__ = ( "epoch", "upstream", "revision", "_key" )
+
+    _cache = {}
+
+    def __new__(cls, ver):
         """Parse a string or number into the three components."""
+        if type(ver) is cls:
+            return ver
+
+        ver = str(ver)
+        try:
+            return cls._cache[ver]
+        except KeyError:
+            pass
+
+        self = super(Version, cls).__new__(cls)
+        self.parse(ver)
+
+        if len(cls._cache) >= CACHE_SIZE:
+            cls._cache.clear()
+        cls._cache[ver] = self
+
+        return self
+
+    def parse(self, ver):
+        """Parse the version string into its components."""
         self.epoch = 0
         self.upstream = None
         self.revision = None
 
-        ver = str(ver)
         if not len(ver):
             raise ValueError
 
@@ -85,6 +129,11 @@ class Version(object):
 
         self.epoch = int(self.epoch)
 
+        epoch = str(self.epoch).lstrip("0")
+        self._key = "%s%s%s%s" % (digits_length(epoch), epoch,
+                                  cached_key(self.upstream),
+                                  cached_key(self.revision or ""))
+
     def getWithoutEpoch(self):
         """Return the version without the epoch."""
         str = self.upstream
@@ -110,20 +159,78 @@ class Version(object):
                % (self.__class__.__name__, self.epoch,
                   self.upstream, self.revision)
 
+    def __reduce__(self):
+        """Pickle the version as its string form."""
+        return (self.__class__, (str(self),))
+
+    def __hash__(self):
+        """Hash versions that compare equal to the same value."""
+        return hash(self._key)
+
     def __cmp__(self, other):
         """Compare two Version classes."""
-        other = Version(other)
+        if not isinstance(other, Version):
+            other = Version(other)
 
-        result = cmp(self.epoch, other.epoch)
-        if result != 0: return result
+        return cmp(self._key, other._key)
 
-        result = deb_cmp(self.upstream, other.upstream)
-        if result != 0: return result
 
-        result = deb_cmp(self.revision or "", other.revision or "")
-        if result != 0: return result
+def version_key(ver):
+    """Return a key for a version that sorts by Debian rules.
 
-        return 0
+    The key is a plain string whose byte order is the same as the Debian
+    order of the versions, so lists of versions can be sorted, searched
+    with bisect or stored in indexes without calling back into Python
+    comparison functions.  The epoch is encoded like the numbers within
+    a component and followed by the keys of the upstream version and
+    revision.
+    """
+    return Version(ver)._key
+
+def cached_key(str):
+    """Return deb_key for a version component, re-using earlier results."""
+    try:
+        return key_cache[str]
+    except KeyError:
+        if len(key_cache) >= CACHE_SIZE:
+            key_cache.clear()
+        key = key_cache[str] = deb_key(str)
+        return key
+
+def deb_key(str):
+    """Return a key for a version component that sorts by Debian rules.
+
+    The key is a string made of each non-digit run of the component,
+    translated so that byte order matches Debian's character order and
+    terminated by "\\x02", followed by the length and digits of the
+    number after it.  Comparing two keys gives the same result as
+    deb_cmp on the original strings.
+    """
+    key = []
+    for (alpha, digits) in part_re.findall(str):
+        if len(alpha) or len(digits) or not len(key):
+            digits = digits.lstrip("0")
+            key.append("%s\x02%s%s" % (alpha.translate(cmp_trans),
+                                        digits_length(digits), digits))
+
+    # Mark the end of the string with an empty run; only the first run
+    # can be empty, so this decides any comparison against a longer
+    # string the same way deb_cmp does
+    key.append("\x02\x00")
+
+    return "".join(key)
+
+def digits_length(digits):
+    """Return the length prefix for a run of digits in a key.
+
+    Runs shorter than 255 digits take a single byte; longer ones are
+    marked with "\xff" followed by their length as four big-endian bytes,
+    so that prefixes still sort in the order of the lengths.
+    """
+    if len(digits) < 255:
+        return chr(len(digits))
+    else:
+        return "\xff" + struct.pack(">I", len(digits))
 
 
 def strcut(str, idx, accept):
@@ -17,9 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import logging
 
 from momlib import *
+from deb.version import version_key
 from util import tree
 
 
@@ -32,7 +34,7 @@ def main(options, args):
     # Run through our default distribution and use that for the base
     # package names.  Expire from all distributions.
     for component in DISTROS[OUR_DISTRO]["components"]:
-        for source in get_sources(OUR_DISTRO, OUR_DIST, component):
+        for source in iter_sources(OUR_DISTRO, OUR_DIST, component):
             base = get_base(source)
             logging.debug("%s %s", source["Package"], source["Version"])
             logging.debug("base is %s", base)
@@ -55,26 +57,24 @@ def expire_pool_sources(distro, package, base):
         return
 
     # Find sources older than the base, record the filenames of newer ones
-    bases = []
-    base_found = False
-    keep = []
-    for source in sources:
-        if base > source["Version"]:
-            bases.append(source)
+    version_sort(sources)
+    keys = [ version_key(source["Version"]) for source in sources ]
+    base_key = version_key(base)
+    idx = bisect.bisect_left(keys, base_key)
+
+    bases = sources[:idx]
+    keep = sources[idx:]
+    base_found = idx < len(keys) and keys[idx] == base_key
+    for source in keep:
+        if base == source["Version"]:
+            logging.info("Leaving %s %s %s (is base)", distro, package,
+                         source["Version"])
         else:
-            if base == source["Version"]:
-                base_found = True
-                logging.info("Leaving %s %s %s (is base)", distro, package,
-                             source["Version"])
-            else:
-                logging.info("Leaving %s %s %s (is newer)", distro, package,
-                             source["Version"])
-
-            keep.append(source)
+            logging.info("Leaving %s %s %s (is newer)", distro, package,
+                         source["Version"])
 
     # If the base wasn't found, we want the newest source below that
     if not base_found and len(bases):
-        version_sort(bases)
         source = bases.pop()
         logging.info("Leaving %s %s %s (is newest before base)",
                      distro, package, source["Version"])
@@ -98,6 +98,7 @@ def expire_pool_sources(distro, package, base):
                 continue
 
             tree.remove("%s/%s/%s" % (ROOT, pooldir, name))
+            tree.remove("%s/%s/%s.partial" % (ROOT, pooldir, name))
             logging.debug("Removed %s/%s", pooldir, name)
             need_update = True
 
@@ -21,7 +21,7 @@ import os
 import logging
 
 from momlib import *
-from util import tree
+from util import shell, tree
 
 
 def options(parser):
@@ -76,6 +76,7 @@ def main(options, args):
 def generate_diff(distro, last, this):
     """Generate the differences."""
     logging.debug("%s: %s %s", distro, this["Package"], this["Version"])
+    shell.set_context(this["Package"])
 
     changes_filename = changes_file(distro, this)
     if not os.path.isfile(changes_filename) \
@@ -95,11 +96,16 @@ def generate_diff(distro, last, this):
     diff_filename = diff_file(distro, this)
     if not os.path.isfile(diff_filename) \
             and not os.path.isfile(diff_filename + ".bz2"):
-        unpack_source(distro, this)
-        unpack_source(distro, last)
-        save_patch_file(diff_filename, last, this)
-        save_basis(diff_filename, last["Version"])
-        logging.info("Saved diff file: %s", tree.subdir(ROOT, diff_filename))
+        try:
+            unpack_source(distro, this)
+            unpack_source(distro, last)
+            save_patch_file(diff_filename, last, this)
+            save_basis(diff_filename, last["Version"])
+            logging.info("Saved diff file: %s",
+                         tree.subdir(ROOT, diff_filename))
+        except (ValueError, OSError):
+            logging.exception("diff for %s failed",
+                              tree.subdir(ROOT, diff_filename))
 
 
 if __name__ == "__main__":
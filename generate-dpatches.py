@@ -21,7 +21,7 @@ import os
 import logging
 
 from momlib import *
-from util import tree
+from util import shell, tree
 
 
 def options(parser):
@@ -65,6 +65,7 @@ def main(options, args):
 def generate_dpatch(distro, source):
     """Generate the extracted patches."""
     logging.debug("%s: %s %s", distro, source["Package"], source["Version"])
+    shell.set_context(source["Package"])
 
     stamp = "%s/%s/dpatch-stamp-%s" \
         % (ROOT, source["Directory"], source["Version"])
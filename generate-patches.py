@@ -21,7 +21,7 @@ import logging
 
 from momlib import *
 from deb.version import Version
-from util import tree
+from util import shell, tree
 from re import search
 
 
@@ -112,6 +112,7 @@ def make_patches(our_distro, our_source, src_distro, src_source, base,
                  slipped=False, force=False):
     """Make sets of patches from the given base."""
     package = our_source["Package"]
+    shell.set_context(package)
     try:
         base_source = get_nearest_source(package, base)
         base_version = Version(base_source["Version"])
@@ -159,13 +160,16 @@ def generate_patch(base_distro, base_source, distro, our_source,
         if basis is not None and basis == base_version:
             return
 
-    unpack_source(base_distro, base_source)
-    unpack_source(distro, our_source)
-
-    ensure(filename)
-    save_patch_file(filename, base_source, our_source)
-    save_basis(filename, base_version)
-    logging.info("Saved patch file: %s", tree.subdir(ROOT, filename))
+    try:
+        unpack_source(base_distro, base_source)
+        unpack_source(distro, our_source)
+
+        ensure(filename)
+        save_patch_file(filename, base_source, our_source)
+        save_basis(filename, base_version)
+        logging.info("Saved patch file: %s", tree.subdir(ROOT, filename))
+    except (ValueError, OSError):
+        logging.exception("patch for %s failed", tree.subdir(ROOT, filename))
 
 
 if __name__ == "__main__":
@@ -22,6 +22,7 @@ from __future__ import print_function, with_statement
 import os
 import re
 import sys
+import glob
 try:
     from hashlib import md5
 except ImportError:
@@ -29,16 +30,27 @@ except ImportError:
     md5 = _mod_md5.new
 import time
 import fcntl
+import bisect
 import errno
+import select
 import logging
 import datetime
 import stat
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import json
+except ImportError:
+    json = None
 
 from cgi import escape
 from optparse import OptionParser
 
 from deb.controlfile import ControlFile
-from deb.version import Version
+from deb.version import Version, version_key
 from util import shell, tree
 
 try:
@@ -79,9 +91,58 @@ SRC_DIST   = "testing"
 RSS_TIME_FORMAT = "%a, %d %b %Y %H:%M:%S %Z"
 
 
+# Fields of Sources paragraphs that we actually use
+SOURCES_FIELDS = ( "Package", "Version", "Binary", "Priority", "Directory",
+                   "Format", "Files", "Checksums-Sha256" )
+
 # Cache of parsed sources files
 SOURCES_CACHE = {}
 
+# Index of cached sources files by package name
+SOURCES_INDEX = {}
+
+# Size of the blocks files are read in when checksumming
+MD5_BLOCK_SIZE = 1 << 20
+
+# Checksums of files already read this run, by (dev, inode, size, mtime,
+# ctime)
+MD5_CACHE = {}
+
+# Total size of unpacked sources to keep between stages and runs
+UNPACK_CACHE_SIZE = 20 * 1024 ** 3
+
+# Unpacked sources in use by this process, and their locked stamp files
+UNPACK_HELD = {}
+
+# Size of the unpacked source cache, None until it's first needed
+UNPACK_TOTAL = None
+
+# Unpacked source cache statistics for this run
+UNPACK_STATS = { "hits": 0, "misses": 0, "evicted": 0, "evicted_size": 0 }
+
+# Seconds between checks of the trash for trees from other processes
+REAP_INTERVAL = 60
+
+# Process id of the background process removing trash, and the pipe used
+# to wake it; closing the pipe tells it to stop
+REAPER = None
+REAPER_WAKE = None
+
+# Number of packages listed in the child process usage summary
+USAGE_TOP_PACKAGES = 10
+
+# Limits on the external tools we run, by command name: seconds they may
+# run for ("timeout") and their address space ("as") and CPU time ("cpu")
+TOOL_LIMITS = {
+    "diff":            { "timeout": 1800, "cpu": 1800, "as": 4 << 30 },
+    "diff3":           { "timeout": 600, "cpu": 600, "as": 4 << 30 },
+    "msgmerge":        { "timeout": 600, "cpu": 600, "as": 2 << 30 },
+    "msgcat":          { "timeout": 600, "cpu": 600, "as": 2 << 30 },
+    "dpkg-source":     { "timeout": 3600, "as": 8 << 30 },
+    "dpkg-genchanges": { "timeout": 600, "as": 2 << 30 },
+    "tar":             { "timeout": 3600, "as": 4 << 30 },
+    }
+
 
 # --------------------------------------------------------------------------- #
 # Command-line tool functions
@@ -95,11 +156,22 @@ def run(main_func, options_func=None, usage=None, description=None):
     parser = OptionParser(usage=usage, description=description)
     parser.add_option("-q", "--quiet", action="callback",
                       callback=quiet_callback, help="Be less chatty")
+    parser.add_option("--usage-json", type="string", metavar="FILENAME",
+                      help="Write resources used by child processes here")
     if options_func is not None:
         options_func(parser)
 
     (options, args) = parser.parse_args()
-    sys.exit(main_func(options, args))
+    shell.DEFAULT_LIMITS.update(TOOL_LIMITS)
+    start_reaper()
+    try:
+        status = main_func(options, args)
+    finally:
+        stop_reaper()
+        report_unpack_stats()
+        report_usage(options.usage_json)
+
+    sys.exit(status)
 
 def quiet_callback(opt, value, parser, *args, **kwds):
     logging.getLogger().setLevel(logging.WARNING)
@@ -115,9 +187,14 @@ def ensure(path):
     if not os.path.isdir(dirname):
         if os.path.islink(dirname) and not os.path.exists(dirname):
             # Broken symbolic link; create the target.
-            os.makedirs(os.path.realpath(dirname))
-        else:
+            dirname = os.path.realpath(dirname)
+
+        try:
             os.makedirs(dirname)
+        except OSError, e:
+            # Another process may have just created it
+            if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+                raise
 
 def pathhash(path):
     """Return the path hash component for path."""
@@ -127,8 +204,11 @@ def pathhash(path):
         return path[:1]
 
 def cleanup(path):
-    """Remove the path and any empty directories up to ROOT."""
-    tree.remove(path)
+    """Remove the path and any empty directories up to ROOT.
+
+    Directories are moved into the trash and removed in the background.
+    """
+    trash(path)
 
     (dirname, basename) = os.path.split(path)
     while dirname != ROOT:
@@ -141,9 +221,186 @@ def cleanup(path):
 
         (dirname, basename) = os.path.split(dirname)
 
-def md5sum(filename):
-    """Return an md5sum."""
-    return md5(open(filename).read()).hexdigest()
+def trash(path):
+    """Move a directory into the trash, or remove anything else."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        tree.remove(path)
+        return
+
+    dirname = trash_dir()
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    # Renaming over an empty directory is allowed, and this one is unique
+    dest = tempfile.mkdtemp(dir=dirname)
+    try:
+        os.rename(path, dest)
+    except OSError, e:
+        os.rmdir(dest)
+        if e.errno == errno.EXDEV:
+            tree.remove(path)
+        elif e.errno != errno.ENOENT:
+            raise
+    else:
+        wake_reaper()
+
+def wake_reaper():
+    """Wake the reaper to remove what's been put in the trash."""
+    if REAPER_WAKE is None:
+        return
+
+    try:
+        os.write(REAPER_WAKE, "\0")
+    except OSError, e:
+        # Pipe full of wake-ups already, or the reaper has gone
+        if e.errno not in (errno.EAGAIN, errno.EPIPE):
+            raise
+
+def start_reaper():
+    """Start the process removing trash in the background.
+
+    This is a separate process rather than a thread so that nothing of
+    ours is running when worker processes are forked, and so that the
+    resources its children use aren't counted against this one.  It's
+    started before anything else, and first removes anything left in
+    the trash by earlier runs.
+    """
+    global REAPER, REAPER_WAKE
+
+    if REAPER is not None:
+        return
+
+    (read_fd, write_fd) = os.pipe()
+    for fd in (read_fd, write_fd):
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    fcntl.fcntl(write_fd, fcntl.F_SETFL,
+                fcntl.fcntl(write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(write_fd)
+            reap_trash(read_fd)
+        except:
+            status = 1
+        os._exit(status)
+
+    os.close(read_fd)
+    REAPER = pid
+    REAPER_WAKE = write_fd
+
+def stop_reaper():
+    """Stop the process removing trash.
+
+    Waits for it to finish removing the tree it's on, so it isn't still
+    running after we exit; anything else left in the trash is removed by
+    the next run.
+    """
+    global REAPER, REAPER_WAKE
+
+    if REAPER is None:
+        return
+
+    os.close(REAPER_WAKE)
+    REAPER_WAKE = None
+    while True:
+        try:
+            os.waitpid(REAPER, 0)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            elif e.errno != errno.ECHILD:
+                raise
+        break
+
+    REAPER = None
+
+def reap_trash(wake_fd):
+    """Remove trash whenever woken, or every REAP_INTERVAL seconds.
+
+    Returns once the other end of wake_fd is closed.
+    """
+    while True:
+        try:
+            empty_trash(wake_fd)
+        except (IOError, OSError), e:
+            logging.warning("Unable to empty trash: %s", e)
+
+        if reaper_stopped(wake_fd, REAP_INTERVAL):
+            break
+
+def reaper_stopped(wake_fd, timeout=0):
+    """Wait up to timeout seconds to be woken; return whether to stop."""
+    while True:
+        try:
+            (readable, writable, errors) \
+                = select.select([ wake_fd ], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        if not len(readable):
+            return False
+
+        # Swallow all the wake-ups at once, end of file means stop
+        return not len(os.read(wake_fd, 4096))
+
+def empty_trash(wake_fd=None):
+    """Remove everything in the trash.
+
+    Uses rm at idle I/O priority, so as not to slow down the real work;
+    rm exits with 1 if another process is also removing the same tree.
+    If wake_fd is given, stops early once told to through it.
+    """
+    dirname = trash_dir()
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return
+
+    for name in names:
+        if wake_fd is not None and reaper_stopped(wake_fd):
+            break
+
+        path = "%s/%s" % (dirname, name)
+        try:
+            shell.run(("ionice", "-c3", "rm", "-rf", path), okstatus=(0, 1))
+        except (ValueError, OSError):
+            tree.remove(path)
+
+def md5sum(filename, st=None):
+    """Return an md5sum.
+
+    The file is read in blocks, and the result is remembered for the rest
+    of the run so that comparing the same file several times only reads
+    it once.  Pass the stat result for the file if it's already known.
+
+    The change time is part of the key as well as the modification time,
+    since a file rewritten in place can keep its size and have its
+    modification time set back, but can't have its change time set.
+    """
+    if st is None:
+        st = os.stat(filename)
+
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+    try:
+        return MD5_CACHE[key]
+    except KeyError:
+        pass
+
+    digest = md5()
+    with open(filename, "rb") as fd:
+        while True:
+            data = fd.read(MD5_BLOCK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+
+    MD5_CACHE[key] = digest.hexdigest()
+    return MD5_CACHE[key]
 
 
 # --------------------------------------------------------------------------- #
@@ -155,6 +412,10 @@ def sources_file(distro, dist, component):
     return "%s/dists/%s-%s/%s/source/Sources" % (ROOT, distro, dist,
                                                     component)
 
+def sources_cache_file(filename):
+    """Return the location of the pre-parsed cache of a Sources file."""
+    return "%s.cache" % filename
+
 def pool_directory(distro, package):
     """Return the pool directory for a source"""
     return "pool/%s/%s/%s" % (pool_name(distro), pathhash(package), package)
@@ -169,6 +430,19 @@ def unpack_directory(source):
     return "%s/unpacked/%s/%s/%s" % (ROOT, pathhash(source["Package"]),
                                      source["Package"], source["Version"])
 
+def upstream_directory(orig_md5sums):
+    """Return the location of a shared unpacked upstream tree."""
+    key = md5("".join(sorted(orig_md5sums))).hexdigest()
+    return "%s/unpacked/.upstream/%s" % (ROOT, key)
+
+def trash_dir():
+    """Return the location of trees waiting to be removed."""
+    return "%s/.trash" % ROOT
+
+def unpack_stamp_file(destdir):
+    """Return the location of the stamp file for an unpacked source."""
+    return destdir + ".stamp"
+
 def changes_file(distro, source):
     """Return the location of a local changes file."""
     return "%s/changes/%s/%s/%s/%s_%s_source.changes" \
@@ -248,21 +522,110 @@ def get_sources(distro, dist, component):
 
     filename = sources_file(distro, dist, component)
     if filename not in SOURCES_CACHE:
-        SOURCES_CACHE[filename] = ControlFile(filename, multi_para=True,
-                                              signed=False)
+        SOURCES_CACHE[filename] = read_sources(filename)
+
+    return SOURCES_CACHE[filename]
+
+def read_sources(filename):
+    """Read the paragraphs of a Sources file.
+
+    The parsed paragraphs are kept in a cache file next to the Sources
+    file, keyed on its size and modification time, so that only the
+    first reader after the Sources file changes has to parse it.
+
+    Only the fields listed in SOURCES_FIELDS are kept.  A cache file that
+    can't be read back is ignored and replaced.
+    """
+    st = os.stat(filename)
+    key = (st.st_size, st.st_mtime, SOURCES_FIELDS)
+
+    cache_filename = sources_cache_file(filename)
+    try:
+        with open(cache_filename, "rb") as cache:
+            (cache_key, paras) = pickle.load(cache)
+        if cache_key == key:
+            return paras
+    except IOError:
+        pass
+    except (pickle.UnpicklingError, EOFError, ValueError, TypeError,
+            AttributeError, ImportError, IndexError, KeyError):
+        logging.debug("Ignoring corrupt %s", cache_filename)
+
+    sources = ControlFile()
+    sources.openMapped(filename, fields=SOURCES_FIELDS)
+    paras = sources.paras
+
+    # Write under a unique name so concurrent readers don't clobber each
+    # other's half-written cache
+    try:
+        (fd, new_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(cache_filename))
+    except OSError:
+        logging.warning("Unable to write %s", cache_filename)
+        return paras
+
+    try:
+        with os.fdopen(fd, "wb") as cache:
+            pickle.dump((key, paras), cache, pickle.HIGHEST_PROTOCOL)
+        # mkstemp makes it private to us
+        os.chmod(new_filename, 0644)
+        os.rename(new_filename, cache_filename)
+    except (IOError, OSError):
+        logging.warning("Unable to write %s", cache_filename)
+        try:
+            os.unlink(new_filename)
+        except OSError:
+            pass
+
+    return paras
+
+def iter_sources(distro, dist, component):
+    """Iterate the paragraphs of a Sources file.
+
+    Unlike get_sources this does not keep the whole file in memory, it
+    is meant for stages that only need a single pass over it.  If the
+    file has already been parsed the cached copy is used instead.
+    """
+    filename = sources_file(distro, dist, component)
+    if filename in SOURCES_CACHE:
+        return iter(SOURCES_CACHE[filename])
+    else:
+        return ControlFile().iterOpen(filename, multi_para=True, signed=False,
+                                      fields=SOURCES_FIELDS)
+
+def forget_sources(distro, dist, component):
+    """Drop any cached copy of a Sources file that has been replaced."""
+    filename = sources_file(distro, dist, component)
+    SOURCES_CACHE.pop(filename, None)
+    SOURCES_INDEX.pop(filename, None)
+
+def get_sources_index(distro, dist, component):
+    """Return the cached Sources file indexed by package name.
+
+    Each package name maps to the list of its paragraphs, sorted by
+    version so the newest is last.  The index is built the first time
+    it is needed and kept alongside the parsed Sources file.
+    """
+    global SOURCES_INDEX
 
-    return SOURCES_CACHE[filename].paras
+    filename = sources_file(distro, dist, component)
+    if filename not in SOURCES_INDEX:
+        index = {}
+        for source in get_sources(distro, dist, component):
+            index.setdefault(source["Package"], []).append(source)
+        for matches in index.itervalues():
+            if len(matches) > 1:
+                version_sort(matches)
+
+        SOURCES_INDEX[filename] = index
+
+    return SOURCES_INDEX[filename]
 
 def get_source(distro, dist, component, package):
     """Return the source for a package in a distro."""
-    sources = get_sources(distro, dist, component)
-    matches = []
-    for source in sources:
-        if source["Package"] == package:
-            matches.append(source)
-    if matches:
-        version_sort(matches)
-        return matches.pop()
+    index = get_sources_index(distro, dist, component)
+    if package in index:
+        return index[package][-1]
     else:
         raise IndexError
 
@@ -345,18 +708,19 @@ def get_nearest_source(package, base):
     except IOError:
         sources = []
 
-    bases = []
-    for source in sources:
-        if base == source["Version"]:
-            return source
-        elif base > source["Version"]:
-            bases.append(source)
-    else:
-        try:
-            return get_pool_source(OUR_DISTRO, package, base)
-        except (IOError, IndexError):
-            version_sort(bases)
-            return bases.pop()
+    version_sort(sources)
+    keys = [ version_key(source["Version"]) for source in sources ]
+    base_key = version_key(base)
+    idx = bisect.bisect_left(keys, base_key)
+    if idx < len(keys) and keys[idx] == base_key:
+        return sources[idx]
+
+    try:
+        return get_pool_source(OUR_DISTRO, package, base)
+    except (IOError, IndexError):
+        if idx == 0:
+            raise IndexError
+        return sources[idx - 1]
 
 def get_same_source(distro, dist, package):
     """Find the same source in another distribution."""
@@ -405,13 +769,25 @@ def get_base(source, slip=False):
 
 def version_sort(sources):
     """Sort the source list by version number."""
-    sources.sort(key=lambda x: Version(x["Version"]))
+    sources.sort(key=lambda x: version_key(x["Version"]))
 
 def files(source):
     """Return (md5sum, size, name) for each file."""
     files = source["Files"].strip("\n").split("\n")
     return [ f.split(None, 2) for f in files ]
 
+def sha256sums(source):
+    """Return the sha256sum of each file by name, if the source has them."""
+    if "Checksums-Sha256" not in source:
+        return {}
+
+    sums = {}
+    for line in source["Checksums-Sha256"].strip("\n").split("\n"):
+        (checksum, size, name) = line.split(None, 2)
+        sums[name] = checksum
+
+    return sums
+
 def read_basis(filename):
     """Read the basis version of a patch from a file."""
     basis_file = filename + "-basis"
@@ -433,11 +809,121 @@ def save_basis(filename, version):
 # --------------------------------------------------------------------------- #
 
 def unpack_source(distro, source):
-    """Unpack the given source and return location."""
+    """Unpack the given source and return location.
+
+    Unpacked sources are kept between stages and runs, identified by the
+    checksum of their dsc file, so each is normally only unpacked once.
+    The tree is locked against eviction until cleanup_source() is called.
+    """
     destdir = unpack_directory(source)
-    if os.path.isdir(destdir):
+    if destdir in UNPACK_HELD:
         return destdir
 
+    for md5sum, size, name in files(source):
+        if name.endswith(".dsc"):
+            dsc_md5sum = md5sum
+            break
+    else:
+        raise ValueError, "Missing dsc file"
+
+    (stamp, extracted) = lock_unpacked(destdir, dsc_md5sum,
+                                       extract_source, distro, source)
+    if extracted:
+        UNPACK_STATS["misses"] += 1
+    else:
+        UNPACK_STATS["hits"] += 1
+
+    UNPACK_HELD[destdir] = stamp
+    if UNPACK_TOTAL is None or UNPACK_TOTAL > UNPACK_CACHE_SIZE:
+        expire_unpacked()
+
+    return destdir
+
+def lock_unpacked(destdir, key, extract_func, *args):
+    """Lock an unpacked tree in the cache against eviction.
+
+    If the tree is missing, or its stamp doesn't match key, it's first
+    created by calling extract_func with args and destdir.  Returns the
+    locked stamp file, which should be closed to release the tree, and
+    whether the tree was extracted.
+
+    The tree is checked under a shared lock, so any number of processes
+    can use it at once.  Only if it needs extracting is the lock upgraded
+    to an exclusive one for that, then downgraded again.
+    """
+    global UNPACK_TOTAL
+
+    stamp_file = unpack_stamp_file(destdir)
+    extracted = False
+    while True:
+        ensure(stamp_file)
+        stamp = open(stamp_file, "a+")
+        try:
+            fcntl.flock(stamp, fcntl.LOCK_SH)
+            if not same_stamp(stamp, stamp_file):
+                # Evicted while we waited for the lock
+                stamp.close()
+                continue
+            elif unpacked_current(stamp, destdir, key):
+                os.utime(stamp_file, None)
+                break
+
+            # Upgrading isn't atomic either, so look again afterwards;
+            # another process may have extracted or evicted the tree
+            fcntl.flock(stamp, fcntl.LOCK_EX)
+            if not same_stamp(stamp, stamp_file):
+                stamp.close()
+                continue
+            elif not unpacked_current(stamp, destdir, key):
+                tree.remove(destdir)
+                try:
+                    extract_func(*(args + (destdir,)))
+                except:
+                    os.unlink(stamp_file)
+                    tree.remove(destdir)
+                    raise
+                extracted = True
+
+                # Files shared with the upstream store are counted there
+                size = tree.size(destdir, shared=False)
+                stamp.truncate(0)
+                stamp.write("%s %d\n" % (key, size))
+                stamp.flush()
+
+                if UNPACK_TOTAL is not None:
+                    UNPACK_TOTAL += size
+
+            os.utime(stamp_file, None)
+
+            # Downgrading isn't atomic, so the tree may have been evicted
+            # in between; start again if it was.
+            fcntl.flock(stamp, fcntl.LOCK_SH)
+            if same_stamp(stamp, stamp_file) and os.path.isdir(destdir):
+                break
+            stamp.close()
+        except:
+            stamp.close()
+            raise
+
+    return (stamp, extracted)
+
+def unpacked_current(stamp, destdir, key):
+    """Return whether the unpacked tree exists and its stamp matches key."""
+    stamp.seek(0)
+    return os.path.isdir(destdir) and stamp.read().split()[:1] == [key]
+
+def same_stamp(stamp, stamp_file):
+    """Return whether the open stamp is still the one at stamp_file."""
+    try:
+        return os.path.samestat(os.fstat(stamp.fileno()),
+                                os.stat(stamp_file))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+def extract_source(distro, source, destdir):
+    """Extract a source package with dpkg-source."""
     srcdir = "%s/%s" % (ROOT, source["Directory"])
     for md5sum, size, name in files(source):
         if name.endswith(".dsc"):
@@ -450,25 +936,203 @@ def unpack_source(distro, source):
     try:
         env = dict(os.environ)
         env['DEB_VENDOR'] = distro
-        shell.run(("dpkg-source", "-x", dsc_file, destdir), chdir=srcdir,
-                  env=env)
+        if not extract_quilt_source(source, srcdir, dsc_file, destdir, env):
+            shell.run(("dpkg-source", "-x", dsc_file, destdir), chdir=srcdir,
+                      env=env)
         # Make sure we can at least read everything under .pc, which isn't
         # automatically true with dpkg-dev 1.15.4.
         pc_dir = os.path.join(destdir, ".pc")
-        for filename in tree.walk(pc_dir):
-            pc_filename = os.path.join(pc_dir, filename)
-            pc_stat = os.lstat(pc_filename)
-            if pc_stat is not None and stat.S_IMODE(pc_stat.st_mode) == 0:
-                os.chmod(pc_filename, 0400)
+        for filename, pc_stat in tree.walk_stat(pc_dir):
+            if stat.S_IMODE(pc_stat.st_mode) == 0:
+                os.chmod(os.path.join(pc_dir, filename), 0400)
     except:
-        cleanup(destdir)
+        tree.remove(destdir)
         raise
 
-    return destdir
+def extract_quilt_source(source, srcdir, dsc_file, destdir, env):
+    """Extract a 3.0 (quilt) source on top of a shared upstream tree.
+
+    The upstream tarballs are extracted only once, into the store under
+    unpacked/.upstream, and each version's tree is made of hardlinks into
+    that with its own debian tarball and patches applied on top.  patch
+    replaces the files it changes rather than writing into them, so the
+    store is never modified.
+
+    Returns False, leaving destdir absent, if the source can't be
+    extracted this way.
+    """
+    if source.get("Format", "").strip() != "3.0 (quilt)":
+        return False
+
+    orig_md5sums = []
+    debian_tar = None
+    for md5sum, size, name in files(source):
+        if name.endswith(".asc"):
+            continue
+        elif ".orig.tar." in name or ".orig-" in name:
+            orig_md5sums.append(md5sum)
+        elif ".debian.tar." in name:
+            debian_tar = name
+
+    if not len(orig_md5sums) or debian_tar is None:
+        return False
+
+    upstream_dir = upstream_directory(orig_md5sums)
+    key = os.path.basename(upstream_dir)
+    try:
+        (stamp, extracted) = lock_unpacked(upstream_dir, key, extract_upstream,
+                                           srcdir, dsc_file)
+        try:
+            tree.copytree(upstream_dir, destdir, link=True)
+        finally:
+            stamp.close()
+
+        # Any upstream debian directory is replaced, not merged with ours
+        tree.remove("%s/debian" % destdir)
+        shell.run(("tar", "--no-same-owner", "--no-same-permissions",
+                   "-xf", "%s/%s" % (srcdir, debian_tar)), chdir=destdir)
+        shell.run(("dpkg-source", "--before-build", destdir), env=env)
+
+        # Otherwise patches would be unapplied by a later --after-build
+        tree.remove("%s/.pc/.dpkg-source-unapply" % destdir)
+    except (ValueError, OSError, IOError), e:
+        logging.warning("Unable to use shared upstream tree for %s: %s",
+                        tree.subdir(ROOT, destdir), e)
+        tree.remove(destdir)
+        return False
+
+    return True
+
+def extract_upstream(srcdir, dsc_file, upstream_dir):
+    """Extract only the upstream tarballs of a source package."""
+    ensure(upstream_dir)
+    try:
+        shell.run(("dpkg-source", "-x", "--no-copy", "--skip-debianization",
+                   dsc_file, upstream_dir), chdir=srcdir)
+    except:
+        tree.remove(upstream_dir)
+        raise
 
 def cleanup_source(source):
-    """Cleanup the given source's unpack location."""
-    cleanup(unpack_directory(source))
+    """Release the given source's unpack location.
+
+    The tree itself is left in place for the next user, and only removed
+    when the cache grows too large.
+    """
+    stamp = UNPACK_HELD.pop(unpack_directory(source), None)
+    if stamp is not None:
+        stamp.close()
+
+def expire_unpacked():
+    """Evict the least recently used unpacked sources.
+
+    Removes unpacked sources, oldest use first, until the cache fits in
+    UNPACK_CACHE_SIZE again.  Sources in use by this or any other process
+    are skipped.
+    """
+    global UNPACK_TOTAL
+
+    stamps = []
+    UNPACK_TOTAL = 0
+    for stamp_file in glob.glob("%s/unpacked/*/*/*.stamp" % ROOT) \
+            + glob.glob("%s/unpacked/.upstream/*.stamp" % ROOT):
+        try:
+            with open(stamp_file) as stamp:
+                size = int(stamp.read().split()[1])
+            mtime = os.stat(stamp_file).st_mtime
+        except (IOError, OSError, IndexError, ValueError):
+            # Being written, or left by an interrupted unpack
+            continue
+
+        stamps.append((mtime, stamp_file, size))
+        UNPACK_TOTAL += size
+
+    stamps.sort()
+    for mtime, stamp_file, size in stamps:
+        if UNPACK_TOTAL <= UNPACK_CACHE_SIZE:
+            break
+
+        destdir = stamp_file[:-len(".stamp")]
+        if destdir in UNPACK_HELD:
+            continue
+
+        try:
+            stamp = open(stamp_file)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+
+        with stamp:
+            try:
+                fcntl.flock(stamp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            if not same_stamp(stamp, stamp_file):
+                continue
+
+            logging.debug("Evicting %s", tree.subdir(ROOT, destdir))
+            os.unlink(stamp_file)
+            cleanup(destdir)
+
+        UNPACK_TOTAL -= size
+        UNPACK_STATS["evicted"] += 1
+        UNPACK_STATS["evicted_size"] += size
+
+def report_unpack_stats():
+    """Log the unpacked source cache statistics for this run."""
+    if UNPACK_STATS["hits"] or UNPACK_STATS["misses"]:
+        logging.info("Unpacked sources: %d reused, %d unpacked, "
+                     "%d evicted (%d MiB)",
+                     UNPACK_STATS["hits"], UNPACK_STATS["misses"],
+                     UNPACK_STATS["evicted"],
+                     UNPACK_STATS["evicted_size"] // (1024 * 1024))
+
+def report_usage(filename=None):
+    """Report the resources used by child processes this run.
+
+    A table of the figures for each command is printed, along with those
+    of the packages that took longest, even with --quiet as that's what
+    cron mails; if filename is given all of the figures are written to
+    it as JSON as well.
+    """
+    commands = shell.usage_totals("command")
+    if not len(commands):
+        return
+
+    packages = shell.usage_totals("context")
+
+    print("Child processes by command:")
+    print_usage_table(commands, len(commands))
+    if len(packages):
+        print("Child processes by package (top %d):" % USAGE_TOP_PACKAGES)
+        print_usage_table(packages, USAGE_TOP_PACKAGES)
+
+    if filename is not None:
+        if json is None:
+            logging.error("No json module, not writing %s", filename)
+            return
+
+        with open(filename + ".new", "w") as usage_file:
+            json.dump({ "commands": commands, "packages": packages },
+                      usage_file, indent=1, sort_keys=True)
+        os.rename(filename + ".new", filename)
+
+def print_usage_table(totals, limit):
+    """Print a table of usage figures, longest wall clock time first."""
+    print("  %-24s %6s %9s %9s %9s %8s %8s %8s"
+          % ("", "calls", "wall(s)", "user(s)", "sys(s)", "rss(MiB)",
+             "in(MiB)", "out(MiB)"))
+    names = sorted(totals, key=lambda name: totals[name]["wall"],
+                   reverse=True)
+    for name in names[:limit]:
+        usage = totals[name]
+        print("  %-24s %6d %9.1f %9.1f %9.1f %8d %8d %8d"
+              % (name, usage["calls"], usage["wall"], usage["utime"],
+                 usage["stime"], usage["maxrss"] // 1024,
+                 usage["inblock"] // 2048, usage["oublock"] // 2048))
 
 def save_changes_file(filename, source, previous=None):
     """Save a changes file for the given source."""
@@ -501,10 +1165,18 @@ def save_patch_file(filename, last, this):
     lastdir = tree.subdir(diffdir, lastdir)
     thisdir = tree.subdir(diffdir, thisdir)
 
+    # Write to a temporary file first so that a diff which fails or is
+    # killed part way through doesn't leave a truncated file behind to
+    # be mistaken for a finished one.
     ensure(filename)
-    with open(filename, "w") as diff:
-        shell.run(("diff", "-pruN", lastdir, thisdir),
-                  chdir=diffdir, stdout=diff, okstatus=(0, 1, 2))
+    try:
+        with open(filename + ".new", "w") as diff:
+            shell.run(("diff", "-pruN", lastdir, thisdir),
+                      chdir=diffdir, stdout=diff, okstatus=(0, 1, 2))
+        os.rename(filename + ".new", filename)
+    except:
+        tree.remove(filename + ".new")
+        raise
 
 
 # --------------------------------------------------------------------------- #
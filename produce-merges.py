@@ -21,12 +21,15 @@ from __future__ import print_function, with_statement
 
 import os
 import re
+import gzip
 import time
 import logging
 import tempfile
+import multiprocessing
 
 from stat import *
 from textwrap import fill
+from contextlib import closing
 
 from momlib import *
 from deb.controlfile import ControlFile
@@ -38,6 +41,9 @@ from util import tree, shell
 CL_RE = re.compile(r'^(\w[-+0-9a-z.]*) \(([^\(\) \t]+)\)((\s+[-0-9a-z]+)+)\;',
                    re.IGNORECASE)
 
+# Number of bytes to look at when deciding whether a file is binary
+BINARY_CHECK_SIZE = 8192
+
 
 def options(parser):
     parser.add_option("-f", "--force", action="store_true",
@@ -73,6 +79,11 @@ def options(parser):
                       action="append",
                       help="Only process packages listed in this file")
 
+    parser.add_option("-j", "--jobs", type="int", metavar="N", default=1,
+                      help="Produce up to N merges in parallel")
+    parser.add_option("--file-jobs", type="int", metavar="N", default=1,
+                      help="Run up to N diff3 or msgmerge at once per merge")
+
 def main(options, args):
     src_distro = options.source_distro
     src_dist = options.source_suite
@@ -95,6 +106,7 @@ def main(options, args):
     # For each package in the destination distribution, locate the latest in
     # the source distribution; calculate the base from the destination and
     # produce a merge combining both sets of changes
+    merges = []
     for our_component in DISTROS[our_distro]["components"]:
         if options.component is not None \
                and our_component not in options.component:
@@ -139,16 +151,122 @@ def main(options, args):
             except IndexError:
                 continue
 
-            produce_merge(our_pool_source, our_distro, our_dist, base_source,
-                          src_pool_source, src_distro, src_dist,
-                          force=options.force)
+            merges.append((our_pool_source, our_distro, our_dist, base_source,
+                           src_pool_source, src_distro, src_dist,
+                           options.force, options.file_jobs))
+
+    if options.jobs > 1:
+        outcomes = produce_merges_parallel(merges, options.jobs)
+    else:
+        outcomes = [ try_merge(merge) for merge in merges ]
+
+    merged = outcomes.count("full") + outcomes.count("debian")
+    logging.info("Produced %d merges, %d of debian/ only", merged,
+                 outcomes.count("debian"))
+    if outcomes.count("failed"):
+        logging.error("Failed to merge %d packages", outcomes.count("failed"))
+
+def produce_merges_parallel(merges, jobs):
+    """Produce the given merges using a pool of worker processes.
+
+    Each merge is produced by merge_worker in its own process, so one
+    failing package doesn't affect the others.  Log messages from each
+    worker are held back and replayed here in the original order of the
+    merges so that the output of different packages isn't interleaved.
+
+    Returns the outcome of each merge as given by produce_merge.
+    """
+    outcomes = []
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for outcome, records, unpack_stats, usage \
+                in pool.imap(merge_worker, merges):
+            for record in records:
+                logging.getLogger().handle(record)
+            for key, value in unpack_stats.items():
+                UNPACK_STATS[key] += value
+            shell.merge_usage(usage)
+            outcomes.append(outcome)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    return outcomes
+
+def merge_worker(merge):
+    """Produce a single merge inside a worker process.
+
+    Returns the outcome of the merge, the log records emitted while
+    doing so, and the unpacked source cache statistics and child process
+    usage for the merge.
+    """
+    for key in UNPACK_STATS:
+        UNPACK_STATS[key] = 0
+    shell.reset_usage()
+
+    handler = RecordingHandler()
+    logger = logging.getLogger()
+    old_handlers = logger.handlers
+    logger.handlers = [ handler ]
+    try:
+        outcome = try_merge(merge)
+    finally:
+        logger.handlers = old_handlers
+
+    return (outcome, handler.records, dict(UNPACK_STATS), dict(shell.USAGE))
+
+def try_merge(merge):
+    """Produce a single merge, logging any failure.
+
+    A failure, such as a tool being killed for running too long, only
+    affects this package.  Returns the outcome of the merge as given by
+    produce_merge, or "failed".
+    """
+    try:
+        return produce_merge(*merge)
+    except Exception:
+        logging.exception("Unable to merge %s", merge[3]["Package"])
+        return "failed"
+
+
+class RecordingHandler(logging.Handler):
+    """Logging handler that keeps records to be passed to another process.
+
+    Messages and exception tracebacks are formatted as they arrive so
+    the records can be pickled.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        self.records.append(record)
+
 
 def produce_merge(left_source, left_distro, left_dist, base_source,
-                  right_source, right_distro, right_dist, force=False):
-    """Produce a merge for the given two packages."""
+                  right_source, right_distro, right_dist, force=False,
+                  file_jobs=1):
+    """Produce a merge for the given two packages.
+
+    Returns "debian" if only the debian directory needed merging, "full"
+    for a merge of the whole tree, or None if no merge was produced.
+    """
     package = base_source["Package"]
     merged_version = Version(right_source["Version"] + "tanglu1")
     output_dir = result_dir(package)
+    shell.set_context(package)
 
     if re.search(".*build[0-9]+$", left_source["Version"]):
         cleanup(output_dir)
@@ -188,9 +306,23 @@ def produce_merge(left_source, left_distro, left_dist, base_source,
 
         merged_dir = work_dir(package, merged_version)
         try:
-            conflicts = do_merge(left_dir, left_name, left_distro, base_dir,
-                                 right_dir, right_name, right_distro,
-                                 merged_dir)
+            if upstream_unchanged((left_source, left_dir),
+                                  (base_source, base_dir),
+                                  (right_source, right_dir)):
+                # Only debian/ can differ, take the rest from the right
+                logging.debug("Upstream unchanged, merging debian/ only")
+                link_upstream(right_dir, merged_dir)
+                conflicts = do_merge(left_dir, left_name, left_distro,
+                                     base_dir, right_dir, right_name,
+                                     right_distro, merged_dir, "debian",
+                                     file_jobs)
+                outcome = "debian"
+            else:
+                conflicts = do_merge(left_dir, left_name, left_distro,
+                                     base_dir, right_dir, right_name,
+                                     right_distro, merged_dir,
+                                     jobs=file_jobs)
+                outcome = "full"
 
             add_changelog(package, merged_version, left_distro, left_dist,
                           right_distro, right_dist, merged_dir)
@@ -229,158 +361,283 @@ def produce_merge(left_source, left_distro, left_dist, base_source,
         cleanup_source(base_source)
         cleanup_source(left_source)
 
+    return outcome
+
+def upstream_unchanged(*sources):
+    """Do the sources only differ in their debian directories?
+
+    Takes (source, unpacked directory) pairs, and returns True if they
+    are all built from the same orig tarballs and none of them changes
+    anything outside debian/.  For 3.0 (quilt) that means having no
+    patches applied and no binary files included from the debian
+    tarball, for 1.0 a diff that only touches debian/.
+    """
+    origs = None
+    for source, dirname in sources:
+        orig_md5sums = []
+        diff_file = None
+        for md5sum, size, name in files(source):
+            if name.endswith(".asc"):
+                continue
+            elif ".orig.tar." in name or ".orig-" in name:
+                orig_md5sums.append(md5sum)
+            elif name.endswith(".diff.gz"):
+                diff_file = "%s/%s/%s" % (ROOT, source["Directory"], name)
 
+        if not len(orig_md5sums):
+            # Native package
+            return False
+        elif origs is None:
+            origs = sorted(orig_md5sums)
+        elif sorted(orig_md5sums) != origs:
+            return False
 
-def do_merge(left_dir, left_name, left_distro, base_dir,
-             right_dir, right_name, right_distro, merged_dir):
-    """Do the heavy lifting of comparing and merging."""
-    logging.debug("Producing merge in %s", tree.subdir(ROOT, merged_dir))
-    conflicts = []
-    po_files = []
+        format = source.get("Format", "1.0").strip()
+        if format == "3.0 (quilt)":
+            applied = "%s/.pc/applied-patches" % dirname
+            if os.path.isfile(applied) and os.path.getsize(applied):
+                return False
+
+            # Binary files can be shipped anywhere in the tree this way
+            if os.path.isfile("%s/debian/source/include-binaries" % dirname):
+                return False
+        elif format == "1.0" and diff_file is not None:
+            with closing(gzip.GzipFile(diff_file)) as diff:
+                for line in diff:
+                    if not line.startswith("+++ "):
+                        continue
+
+                    filename = line[4:].split("\t")[0].rstrip("\n")
+                    if not tree.under("debian", filename.split("/", 1)[-1]):
+                        return False
+        else:
+            return False
+
+    return True
 
-    # Look for files in the base and merge them if they're in both new
-    # files (removed files get removed)
-    for filename in tree.walk(base_dir):
-        if tree.under(".pc", filename):
-            # Not interested in merging quilt metadata
+def link_upstream(right_dir, merged_dir):
+    """Hardlink everything outside debian/ from right into the merge."""
+    for filename in tree.walk(right_dir):
+        if not len(filename):
+            continue
+        elif tree.under("debian", filename) or tree.under(".pc", filename):
             continue
 
-        base_stat = os.lstat("%s/%s" % (base_dir, filename))
+        tree.copyfile("%s/%s" % (right_dir, filename),
+                      "%s/%s" % (merged_dir, filename), link=True)
 
-        try:
-            left_stat = os.lstat("%s/%s" % (left_dir, filename))
-        except OSError:
-            left_stat = None
 
-        try:
-            right_stat = os.lstat("%s/%s" % (right_dir, filename))
-        except OSError:
-            right_stat = None
 
-        if left_stat is None and right_stat is None:
-            # Removed on both sides
-            pass
+def do_merge(left_dir, left_name, left_distro, base_dir,
+             right_dir, right_name, right_distro, merged_dir, subdir=None,
+             jobs=1):
+    """Do the heavy lifting of comparing and merging.
 
-        elif left_stat is None:
-            logging.debug("removed from %s: %s", left_distro, filename)
-            if not same_file(base_stat, base_dir, right_stat, right_dir,
-                             filename):
-                # Changed on RHS
-                conflict_file(left_dir, left_distro, right_dir, right_distro,
-                              merged_dir, filename)
-                conflicts.append(filename)
+    If subdir is given only that part of the trees is merged.  Files
+    that need diff3 or msgmerge are merged last, up to jobs at once.
+    """
+    logging.debug("Producing merge in %s", tree.subdir(ROOT, merged_dir))
+    conflicts = []
+    diff3_files = []
+    po_files = []
 
-        elif right_stat is None:
-            # Removed on RHS only
-            logging.debug("removed from %s: %s", right_distro, filename)
-            if not same_file(base_stat, base_dir, left_stat, left_dir,
-                             filename):
-                # Changed on LHS
-                conflict_file(left_dir, left_distro, right_dir, right_distro,
-                              merged_dir, filename)
-                conflicts.append(filename)
+    (entries, stat_calls) = merge_table(base_dir, left_dir, right_dir,
+                                        subdir)
+    logging.debug("Read %d paths with %d stat calls", len(entries),
+                  stat_calls)
 
-        elif S_ISREG(left_stat.st_mode) and S_ISREG(right_stat.st_mode):
-            # Common case: left and right are both files
-            if handle_file(left_stat, left_dir, left_name, left_distro,
+    # Sorting the paths puts every directory before its contents
+    for filename in sorted(entries):
+        (base_stat, left_stat, right_stat) = entries[filename]
+
+        if base_stat is not None:
+            # In the base: merge if it's in both new trees, removed files
+            # get removed
+            if handle_base(left_stat, left_dir, left_name, left_distro,
                            right_dir, right_stat, right_name, right_distro,
                            base_stat, base_dir, merged_dir, filename,
-                           po_files):
+                           diff3_files, po_files):
                 conflicts.append(filename)
 
-        elif same_file(left_stat, left_dir, right_stat, right_dir, filename):
-            # left and right are the same, doesn't matter which we keep
-            tree.copyfile("%s/%s" % (right_dir, filename),
+        elif left_stat is not None and right_stat is not None:
+            # New on both sides: conflict unless they can be merged
+            if handle_new(left_stat, left_dir, left_name, left_distro,
+                          right_dir, right_stat, right_name, right_distro,
+                          merged_dir, filename, diff3_files, po_files):
+                conflicts.append(filename)
+
+        elif left_stat is not None:
+            logging.debug("new in %s: %s", left_distro, filename)
+            tree.copyfile("%s/%s" % (left_dir, filename),
                           "%s/%s" % (merged_dir, filename))
 
-        elif same_file(base_stat, base_dir, left_stat, left_dir, filename):
-            # right has changed in some way, keep that one
-            logging.debug("preserving non-file change in %s: %s",
-                          right_distro, filename)
+        else:
+            logging.debug("new in %s: %s", right_distro, filename)
             tree.copyfile("%s/%s" % (right_dir, filename),
                           "%s/%s" % (merged_dir, filename))
 
-        elif same_file(base_stat, base_dir, right_stat, right_dir, filename):
-            # left has changed in some way, keep that one
-            logging.debug("preserving non-file change in %s: %s",
-                          left_distro, filename)
-            tree.copyfile("%s/%s" % (left_dir, filename),
-                          "%s/%s" % (merged_dir, filename))
-        else:
-            # all three differ, mark a conflict
+    # Files changed on both sides and po files are left until now as
+    # they need external tools, which can run alongside each other
+    with shell.Pool(jobs) as pool:
+        diff3_jobs = [ (filename,
+                        merge_file(pool, left_dir, left_name, base_dir,
+                                   right_dir, right_name, merged_dir,
+                                   filename))
+                       for filename in diff3_files ]
+        po_jobs = [ (filename,
+                     pool.submit(merge_po, left_dir, right_dir, merged_dir,
+                                 filename))
+                    for filename in po_files ]
+
+    for filename, job in diff3_jobs:
+        if diff3_result(job, left_dir, left_distro, right_dir, right_distro,
+                        merged_dir, filename):
+            conflicts.append(filename)
+            continue
+
+        (base_stat, left_stat, right_stat) = entries[filename]
+        merge_attr(base_stat, left_stat, right_stat, merged_dir, filename)
+
+    # Handle po files separately as they need special merging
+    for filename, job in po_jobs:
+        if job.result():
             conflict_file(left_dir, left_distro, right_dir, right_distro,
                           merged_dir, filename)
             conflicts.append(filename)
-
-    # Look for files in the left hand side that aren't in the base,
-    # conflict if new on both sides or copy into the tree
-    for filename in tree.walk(left_dir):
-        if tree.under(".pc", filename):
-            # Not interested in merging quilt metadata
             continue
 
-        if tree.exists("%s/%s" % (base_dir, filename)):
-            continue
+        (base_stat, left_stat, right_stat) = entries[filename]
+        merge_attr(base_stat, left_stat, right_stat, merged_dir, filename)
 
-        if not tree.exists("%s/%s" % (right_dir, filename)):
-            logging.debug("new in %s: %s", left_distro, filename)
-            tree.copyfile("%s/%s" % (left_dir, filename),
-                          "%s/%s" % (merged_dir, filename))
-            continue
+    return conflicts
 
-        left_stat = os.lstat("%s/%s" % (left_dir, filename))
-        right_stat = os.lstat("%s/%s" % (right_dir, filename))
+def merge_table(base_dir, left_dir, right_dir, subdir=None):
+    """Read the three trees to be merged into a single table.
+
+    Each tree is walked once and every path in it stat'd once, the
+    merge then works from the results.  Returns a dictionary mapping
+    every path found in any of the trees to a (base, left, right) tuple
+    of lstat results, with None where the path is missing from a tree,
+    along with the number of stat calls made.  If subdir is given only
+    that part of each tree is read.
+    """
+    entries = {}
+    stat_calls = 0
+
+    for (idx, dirname) in enumerate((base_dir, left_dir, right_dir)):
+        if subdir is not None:
+            walk_dir = "%s/%s" % (dirname, subdir)
+        else:
+            walk_dir = dirname
 
-        if S_ISREG(left_stat.st_mode) and S_ISREG(right_stat.st_mode):
-            # Common case: left and right are both files
-            if handle_file(left_stat, left_dir, left_name, left_distro,
-                           right_dir, right_stat, right_name, right_distro,
-                           None, None, merged_dir, filename,
-                           po_files):
-                conflicts.append(filename)
+        for filename, st in tree.walk_stat(walk_dir):
+            stat_calls += 1
+            if subdir is not None:
+                filename = os.path.join(subdir, filename).rstrip("/")
 
-        elif same_file(left_stat, left_dir, right_stat, right_dir, filename):
-            # left and right are the same, doesn't matter which we keep
-            tree.copyfile("%s/%s" % (right_dir, filename),
-                          "%s/%s" % (merged_dir, filename))
+            if tree.under(".pc", filename):
+                # Not interested in merging quilt metadata
+                continue
 
-        else:
-            # they differ, mark a conflict
+            entry = entries.setdefault(filename, [ None, None, None ])
+            entry[idx] = st
+
+    for filename in entries:
+        entries[filename] = tuple(entries[filename])
+
+    return (entries, stat_calls)
+
+def handle_base(left_stat, left_dir, left_name, left_distro,
+                right_dir, right_stat, right_name, right_distro,
+                base_stat, base_dir, merged_dir, filename, diff3_files,
+                po_files):
+    """Handle a path that exists in the base."""
+    if left_stat is None and right_stat is None:
+        # Removed on both sides
+        pass
+
+    elif left_stat is None:
+        logging.debug("removed from %s: %s", left_distro, filename)
+        if not same_file(base_stat, base_dir, right_stat, right_dir,
+                         filename):
+            # Changed on RHS
             conflict_file(left_dir, left_distro, right_dir, right_distro,
                           merged_dir, filename)
-            conflicts.append(filename)
+            return True
 
-    # Copy new files on the right hand side only into the tree
-    for filename in tree.walk(right_dir):
-        if tree.under(".pc", filename):
-            # Not interested in merging quilt metadata
-            continue
+    elif right_stat is None:
+        # Removed on RHS only
+        logging.debug("removed from %s: %s", right_distro, filename)
+        if not same_file(base_stat, base_dir, left_stat, left_dir,
+                         filename):
+            # Changed on LHS
+            conflict_file(left_dir, left_distro, right_dir, right_distro,
+                          merged_dir, filename)
+            return True
 
-        if tree.exists("%s/%s" % (base_dir, filename)):
-            continue
+    elif S_ISREG(left_stat.st_mode) and S_ISREG(right_stat.st_mode):
+        # Common case: left and right are both files
+        if handle_file(left_stat, left_dir, left_name, left_distro,
+                       right_dir, right_stat, right_name, right_distro,
+                       base_stat, base_dir, merged_dir, filename,
+                       diff3_files, po_files):
+            return True
 
-        if tree.exists("%s/%s" % (left_dir, filename)):
-            continue
+    elif same_file(left_stat, left_dir, right_stat, right_dir, filename):
+        # left and right are the same, doesn't matter which we keep
+        tree.copyfile("%s/%s" % (right_dir, filename),
+                      "%s/%s" % (merged_dir, filename))
 
-        logging.debug("new in %s: %s", right_distro, filename)
+    elif same_file(base_stat, base_dir, left_stat, left_dir, filename):
+        # right has changed in some way, keep that one
+        logging.debug("preserving non-file change in %s: %s",
+                      right_distro, filename)
         tree.copyfile("%s/%s" % (right_dir, filename),
                       "%s/%s" % (merged_dir, filename))
 
-    # Handle po files separately as they need special merging
-    for filename in po_files:
-        if merge_po(left_dir, right_dir, merged_dir, filename):
-            conflict_file(left_dir, left_distro, right_dir, right_distro,
-                          merged_dir, filename)
-            conflicts.append(filename)
-            continue
+    elif same_file(base_stat, base_dir, right_stat, right_dir, filename):
+        # left has changed in some way, keep that one
+        logging.debug("preserving non-file change in %s: %s",
+                      left_distro, filename)
+        tree.copyfile("%s/%s" % (left_dir, filename),
+                      "%s/%s" % (merged_dir, filename))
+    else:
+        # all three differ, mark a conflict
+        conflict_file(left_dir, left_distro, right_dir, right_distro,
+                      merged_dir, filename)
+        return True
 
-        merge_attr(base_dir, left_dir, right_dir, merged_dir, filename)
+    return False
 
-    return conflicts
+def handle_new(left_stat, left_dir, left_name, left_distro,
+               right_dir, right_stat, right_name, right_distro,
+               merged_dir, filename, diff3_files, po_files):
+    """Handle a path that is new in both left and right."""
+    if S_ISREG(left_stat.st_mode) and S_ISREG(right_stat.st_mode):
+        # Common case: left and right are both files
+        if handle_file(left_stat, left_dir, left_name, left_distro,
+                       right_dir, right_stat, right_name, right_distro,
+                       None, None, merged_dir, filename,
+                       diff3_files, po_files):
+            return True
+
+    elif same_file(left_stat, left_dir, right_stat, right_dir, filename):
+        # left and right are the same, doesn't matter which we keep
+        tree.copyfile("%s/%s" % (right_dir, filename),
+                      "%s/%s" % (merged_dir, filename))
+
+    else:
+        # they differ, mark a conflict
+        conflict_file(left_dir, left_distro, right_dir, right_distro,
+                      merged_dir, filename)
+        return True
+
+    return False
 
 def handle_file(left_stat, left_dir, left_name, left_distro,
                 right_dir, right_stat, right_name, right_distro,
-                base_stat, base_dir, merged_dir, filename, po_files):
+                base_stat, base_dir, merged_dir, filename, diff3_files,
+                po_files):
     """Handle the common case of a file in both left and right."""
     if filename == "debian/changelog":
         # two-way merge of changelogs
@@ -399,10 +656,21 @@ def handle_file(left_stat, left_dir, left_name, left_distro,
             return True
     elif base_stat is not None and S_ISREG(base_stat.st_mode):
         # was file in base: diff3 possible
-        if merge_file(left_dir, left_name, left_distro, base_dir,
-                      right_dir, right_name, right_distro, merged_dir,
-                      filename):
+        if resolve_file(left_stat, left_dir, left_distro, base_stat, base_dir,
+                        right_stat, right_dir, right_distro, merged_dir,
+                        filename):
+            pass
+        elif is_binary("%s/%s" % (left_dir, filename)) \
+                 or is_binary("%s/%s" % (base_dir, filename)) \
+                 or is_binary("%s/%s" % (right_dir, filename)):
+            logging.debug("binary file conflict: %s", filename)
+            conflict_file(left_dir, left_distro, right_dir, right_distro,
+                          merged_dir, filename)
             return True
+        else:
+            # three-way merge of contents (do later)
+            diff3_files.append(filename)
+            return False
     elif same_file(left_stat, left_dir, right_stat, right_dir, filename):
         # same file in left and right
         logging.debug("%s and %s both turned into same file: %s",
@@ -416,7 +684,7 @@ def handle_file(left_stat, left_dir, left_name, left_distro,
         return True
 
     # Apply permissions
-    merge_attr(base_dir, left_dir, right_dir, merged_dir, filename)
+    merge_attr(base_stat, left_stat, right_stat, merged_dir, filename)
     return False
 
 def same_file(left_stat, left_dir, right_stat, right_dir, filename):
@@ -428,8 +696,8 @@ def same_file(left_stat, left_dir, right_stat, right_dir, filename):
         # Files with the same size and MD5sum are the same
         if left_stat.st_size != right_stat.st_size:
             return False
-        elif md5sum("%s/%s" % (left_dir, filename)) \
-                 != md5sum("%s/%s" % (right_dir, filename)):
+        elif md5sum("%s/%s" % (left_dir, filename), left_stat) \
+                 != md5sum("%s/%s" % (right_dir, filename), right_stat):
             return False
         else:
             return True
@@ -557,76 +825,103 @@ def find_closest_pot(po_file):
         return None
 
 
-def merge_file(left_dir, left_name, left_distro, base_dir,
-               right_dir, right_name, right_distro, merged_dir, filename):
-    """Merge a file using diff3."""
+def resolve_file(left_stat, left_dir, left_distro, base_stat, base_dir,
+                 right_stat, right_dir, right_distro, merged_dir, filename):
+    """Resolve a file changed on at most one side.
+
+    Most files are unchanged on at least one side, those are resolved
+    by comparing the three versions and taking the changed one.  Returns
+    False, having done nothing, if both sides have made different changes
+    and diff3 is needed.
+    """
+    if same_file(left_stat, left_dir, right_stat, right_dir, filename):
+        # same changes (or none) on both sides
+        tree.copyfile("%s/%s" % (left_dir, filename),
+                      "%s/%s" % (merged_dir, filename))
+        return True
+    elif same_file(base_stat, base_dir, left_stat, left_dir, filename):
+        logging.debug("preserving change in %s: %s", right_distro, filename)
+        tree.copyfile("%s/%s" % (right_dir, filename),
+                      "%s/%s" % (merged_dir, filename))
+        return True
+    elif same_file(base_stat, base_dir, right_stat, right_dir, filename):
+        logging.debug("preserving change in %s: %s", left_distro, filename)
+        tree.copyfile("%s/%s" % (left_dir, filename),
+                      "%s/%s" % (merged_dir, filename))
+        return True
+    else:
+        return False
+
+def merge_file(pool, left_dir, left_name, base_dir, right_dir, right_name,
+               merged_dir, filename):
+    """Merge a file using diff3.
+
+    The merge is submitted to the pool, returns the job which gives the
+    exit status of diff3; pass it to diff3_result() once it's done.
+    """
     dest = "%s/%s" % (merged_dir, filename)
     ensure(dest)
 
-    with open(dest, "w") as output:
-        status = shell.run(("diff3", "-E", "-m",
-                            "-L", left_name, "%s/%s" % (left_dir, filename),
-                            "-L", "BASE", "%s/%s" % (base_dir, filename),
-                            "-L", right_name, "%s/%s" % (right_dir, filename)),
-                           stdout=output, okstatus=(0,1,2))
+    return pool.submit(run_to_file, dest,
+                       ("diff3", "-E", "-m",
+                        "-L", left_name, "%s/%s" % (left_dir, filename),
+                        "-L", "BASE", "%s/%s" % (base_dir, filename),
+                        "-L", right_name, "%s/%s" % (right_dir, filename)),
+                       okstatus=(0,1,2))
+
+def run_to_file(filename, args, **kwds):
+    """Run a process with its output written to the file given."""
+    with open(filename, "w") as output:
+        return shell.run(args, stdout=output, **kwds)
+
+def diff3_result(job, left_dir, left_distro, right_dir, right_distro,
+                 merged_dir, filename):
+    """Deal with the outcome of a diff3 merge.
+
+    Returns True if the file was left with conflicts.
+    """
+    dest = "%s/%s" % (merged_dir, filename)
+    status = job.result()
 
     if status != 0:
         if not tree.exists(dest) or os.stat(dest).st_size == 0:
-            # Probably binary
-            if same_file(os.stat("%s/%s" % (left_dir, filename)), left_dir,
-                         os.stat("%s/%s" % (right_dir, filename)), right_dir,
-                         filename):
-                logging.debug("binary files are the same: %s", filename)
-                tree.copyfile("%s/%s" % (left_dir, filename),
-                              "%s/%s" % (merged_dir, filename))
-            elif same_file(os.stat("%s/%s" % (base_dir, filename)), base_dir,
-                           os.stat("%s/%s" % (left_dir, filename)), left_dir,
-                           filename):
-                logging.debug("preserving binary change in %s: %s",
-                              right_distro, filename)
-                tree.copyfile("%s/%s" % (right_dir, filename),
-                              "%s/%s" % (merged_dir, filename))
-            elif same_file(os.stat("%s/%s" % (base_dir, filename)), base_dir,
-                           os.stat("%s/%s" % (right_dir, filename)), right_dir,
-                           filename):
-                logging.debug("preserving binary change in %s: %s",
-                              left_distro, filename)
-                tree.copyfile("%s/%s" % (left_dir, filename),
-                              "%s/%s" % (merged_dir, filename))
-            else:
-                logging.debug("binary file conflict: %s", filename)
-                conflict_file(left_dir, left_distro, right_dir, right_distro,
-                              merged_dir, filename)
-                return True
+            # diff3 gave up on it
+            logging.debug("unmergeable file conflict: %s", filename)
+            conflict_file(left_dir, left_distro, right_dir, right_distro,
+                          merged_dir, filename)
+            return True
         else:
             logging.debug("Conflict in %s", filename)
             return True
     else:
         return False
 
+def is_binary(filename):
+    """Does the file look like binary data?
+
+    Uses the same test as diff, a NUL byte near the start of the file.
+    """
+    with open(filename) as fd:
+        return "\0" in fd.read(BINARY_CHECK_SIZE)
 
-def merge_attr(base_dir, left_dir, right_dir, merged_dir, filename):
+
+def merge_attr(base_stat, left_stat, right_stat, merged_dir, filename):
     """Set initial and merge changed attributes."""
-    if base_dir is not None \
-           and os.path.isfile("%s/%s" % (base_dir, filename)) \
-           and not os.path.islink("%s/%s" % (base_dir, filename)):
-        set_attr(base_dir, merged_dir, filename)
-        apply_attr(base_dir, left_dir, merged_dir, filename)
-        apply_attr(base_dir, right_dir, merged_dir, filename)
+    if base_stat is not None and S_ISREG(base_stat.st_mode):
+        set_attr(base_stat, merged_dir, filename)
+        apply_attr(base_stat, left_stat, merged_dir, filename)
+        apply_attr(base_stat, right_stat, merged_dir, filename)
     else:
-        set_attr(right_dir, merged_dir, filename)
-        apply_attr(right_dir, left_dir, merged_dir, filename)
+        set_attr(right_stat, merged_dir, filename)
+        apply_attr(right_stat, left_stat, merged_dir, filename)
 
-def set_attr(src_dir, dest_dir, filename):
+def set_attr(src_stat, dest_dir, filename):
     """Set the initial attributes."""
-    mode = os.stat("%s/%s" % (src_dir, filename)).st_mode & 0777
+    mode = src_stat.st_mode & 0777
     os.chmod("%s/%s" % (dest_dir, filename), mode)
 
-def apply_attr(base_dir, src_dir, dest_dir, filename):
+def apply_attr(base_stat, src_stat, dest_dir, filename):
     """Apply attribute changes from one side to a file."""
-    src_stat = os.stat("%s/%s" % (src_dir, filename))
-    base_stat = os.stat("%s/%s" % (base_dir, filename))
-
     for shift in range(0, 9):
         bit = 1 << shift
 
@@ -730,15 +1025,36 @@ def copy_in(output_dir, source, distro=None):
         return None
 
 
+def staging_dir(merged_dir):
+    """Make a temporary directory on the same filesystem as the merge."""
+    return tempfile.mkdtemp(dir=os.path.dirname(merged_dir))
+
+def stage_tree(merged_dir, dest):
+    """Make a copy of the merged tree to build from.
+
+    Everything outside debian/ is hardlinked rather than copied, falling
+    back to a copy where that isn't possible.  Files in debian/ are
+    always copied as the builders may change them, and the rest may be
+    shared with the unpacked sources.
+    """
+    os.makedirs(dest)
+    for name in os.listdir(merged_dir):
+        srcpath = "%s/%s" % (merged_dir, name)
+        dstpath = "%s/%s" % (dest, name)
+        if os.path.isdir(srcpath) and not os.path.islink(srcpath):
+            tree.copytree(srcpath, dstpath, link=(name != "debian"))
+        else:
+            tree.copyfile(srcpath, dstpath, link=(name != "debian"))
+
 def create_tarball(package, version, output_dir, merged_dir):
     """Create a tarball of a merge with conflicts."""
     filename = "%s/%s_%s.src.tar.gz" % (output_dir, package,
                                         version.without_epoch)
     contained = "%s-%s" % (package, version.without_epoch)
 
-    parent = tempfile.mkdtemp()
+    parent = staging_dir(merged_dir)
     try:
-        tree.copytree(merged_dir, "%s/%s" % (parent, contained))
+        stage_tree(merged_dir, "%s/%s" % (parent, contained))
 
         debian_rules = "%s/%s/debian/rules" % (parent, contained)
         if os.path.isfile(debian_rules):
@@ -756,9 +1072,9 @@ def create_source(package, version, since, output_dir, merged_dir):
     contained = "%s-%s" % (package, version.upstream)
     filename = "%s_%s.dsc" % (package, version.without_epoch)
 
-    parent = tempfile.mkdtemp()
+    parent = staging_dir(merged_dir)
     try:
-        tree.copytree(merged_dir, "%s/%s" % (parent, contained))
+        stage_tree(merged_dir, "%s/%s" % (parent, contained))
 
         orig_filename = "%s_%s.orig.tar.gz" % (package, version.upstream)
         if os.path.isfile("%s/%s" % (output_dir, orig_filename)):
@@ -796,10 +1112,11 @@ def create_patch(package, version, output_dir, merged_dir,
     """Create the merged patch."""
     filename = "%s/%s_%s.patch" % (output_dir, package, version)
 
-    parent = tempfile.mkdtemp()
+    parent = staging_dir(merged_dir)
     try:
-        tree.copytree(merged_dir, "%s/%s" % (parent, version))
-        tree.copytree(right_dir, "%s/%s" % (parent, right_source["Version"]))
+        # diff only reads the trees, so just give them the right names
+        os.symlink(merged_dir, "%s/%s" % (parent, version))
+        os.symlink(right_dir, "%s/%s" % (parent, right_source["Version"]))
 
         with open(filename, "w") as diff:
             shell.run(("diff", "-pruN",
@@ -819,66 +1136,9 @@ def write_report(left_source, left_distro, left_patch, base_source,
     """Write the merge report."""
     filename = "%s/REPORT" % output_dir
     with open(filename, "w") as report:
-        package = base_source["Package"]
-
-        # Package and time
-        print("%s" % package, file=report)
-        print("%s" % time.ctime(), file=report)
-        print(file=report)
-
-        # General rambling
-        print(fill("Below now follows the report of the automated "
-                   "merge of the %s changes to the %s source "
-                   "package against the new %s version."
-                   % (left_distro.title(), package, right_distro.title())),
-              file=report)
-        print(file=report)
-        print(fill("This file is designed to be both human readable "
-                   "and machine-parseable.  Any line beginning with "
-                   "four spaces is a file that should be downloaded "
-                   "for the complete merge set."), file=report)
-        print(file=report)
-        print(file=report)
-
-        print(fill("Here are the particulars of the three versions "
-                   "of %s that were chosen for the merge.  The base "
-                   "is the newest version that is a common ancestor "
-                   "of both the %s and %s packages.  It may be of "
-                   "a different upstream version, but that's not "
-                   "usually a problem."
-                   % (package, left_distro.title(), right_distro.title())),
-              file=report)
-        print(file=report)
-        print(fill("The files are the source package itself, and "
-                   "the patch from the common base to that version."),
-              file=report)
-        print(file=report)
-
-        # Base version and files
-        print("base: %s" % base_source["Version"], file=report)
-        for md5sum, size, name in files(base_source):
-            print("    %s" % name, file=report)
-        print(file=report)
-
-        # Left version and files
-        print("%s: %s" % (left_distro, left_source["Version"]), file=report)
-        for md5sum, size, name in files(left_source):
-            print("    %s" % name, file=report)
-        print(file=report)
-        if left_patch is not None:
-            print("base -> %s" % left_distro, file=report)
-            print("    %s" % left_patch, file=report)
-            print(file=report)
-
-        # Right version and files
-        print("%s: %s" % (right_distro, right_source["Version"]), file=report)
-        for md5sum, size, name in files(right_source):
-            print("    %s" % name, file=report)
-        print(file=report)
-        if right_patch is not None:
-            print("base -> %s" % right_distro, file=report)
-            print("    %s" % right_patch, file=report)
-            print(file=report)
+        write_particulars(report, left_source, left_distro, left_patch,
+                          base_source, right_source, right_distro,
+                          right_patch)
 
         # Generated section
         print(file=report)
@@ -980,6 +1240,70 @@ def write_report(left_source, left_distro, left_patch, base_source,
               % (left_source["Version"], sa_arg), file=report)
 
 
+def write_particulars(report, left_source, left_distro, left_patch,
+                      base_source, right_source, right_distro, right_patch):
+    """Write the introduction and versions of a merge report."""
+    package = base_source["Package"]
+
+    # Package and time
+    print("%s" % package, file=report)
+    print("%s" % time.ctime(), file=report)
+    print(file=report)
+
+    # General rambling
+    print(fill("Below now follows the report of the automated "
+               "merge of the %s changes to the %s source "
+               "package against the new %s version."
+               % (left_distro.title(), package, right_distro.title())),
+          file=report)
+    print(file=report)
+    print(fill("This file is designed to be both human readable "
+               "and machine-parseable.  Any line beginning with "
+               "four spaces is a file that should be downloaded "
+               "for the complete merge set."), file=report)
+    print(file=report)
+    print(file=report)
+
+    print(fill("Here are the particulars of the three versions "
+               "of %s that were chosen for the merge.  The base "
+               "is the newest version that is a common ancestor "
+               "of both the %s and %s packages.  It may be of "
+               "a different upstream version, but that's not "
+               "usually a problem."
+               % (package, left_distro.title(), right_distro.title())),
+          file=report)
+    print(file=report)
+    print(fill("The files are the source package itself, and "
+               "the patch from the common base to that version."),
+          file=report)
+    print(file=report)
+
+    # Base version and files
+    print("base: %s" % base_source["Version"], file=report)
+    for md5sum, size, name in files(base_source):
+        print("    %s" % name, file=report)
+    print(file=report)
+
+    # Left version and files
+    print("%s: %s" % (left_distro, left_source["Version"]), file=report)
+    for md5sum, size, name in files(left_source):
+        print("    %s" % name, file=report)
+    print(file=report)
+    if left_patch is not None:
+        print("base -> %s" % left_distro, file=report)
+        print("    %s" % left_patch, file=report)
+        print(file=report)
+
+    # Right version and files
+    print("%s: %s" % (right_distro, right_source["Version"]), file=report)
+    for md5sum, size, name in files(right_source):
+        print("    %s" % name, file=report)
+    print(file=report)
+    if right_patch is not None:
+        print("base -> %s" % right_distro, file=report)
+        print("    %s" % right_patch, file=report)
+        print(file=report)
+
 def read_package_list(filename):
     """Read a list of packages from the given file."""
     packages = []
@@ -47,7 +47,7 @@ def main(options, args):
         # For each package in the distribution, check for a patch for the
         # current version; publish if it exists, clean up if not
         for component in DISTROS[distro]["components"]:
-            for source in get_sources(distro, dist, component):
+            for source in iter_sources(distro, dist, component):
                 package = source["Package"]
 
                 if package in blacklist:
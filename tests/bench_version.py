@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/bench_version.py - time sorting versions
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare sorting versions by key with sorting them through deb_cmp.
+
+The deb_cmp sort is given already parsed Versions, so it's a lower bound
+on what Version cost before it had keys, when it also parsed a version
+string on every comparison.  The keyed sorts are timed with the caches
+of parsed versions and components both empty and already filled.
+
+Run as "python -m tests.bench_version" from the top of the tree.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import random
+from optparse import OptionParser
+
+from deb import version
+from deb.version import Version, version_key
+from tests.test_version import reference_cmp
+
+
+def random_version(rand):
+    """Return a random version shaped like those found in Sources."""
+    ver = "%d.%d" % (rand.randint(0, 20), rand.randint(0, 200))
+    if rand.random() < 0.3:
+        ver += rand.choice([ "~rc1", "+dfsg", "~beta2", ".1", "a" ])
+    if rand.random() < 0.8:
+        ver += "-%d%s" % (rand.randint(0, 9),
+                          rand.choice([ "", "ubuntu1", "build2", "+b1",
+                                        "~bpo1" ]))
+    if rand.random() < 0.1:
+        ver = "%d:%s" % (rand.randint(1, 3), ver)
+    return ver
+
+def clear_caches():
+    """Forget every parsed version and component key."""
+    Version._cache.clear()
+    version.key_cache.clear()
+
+def timed(func, *args, **kwds):
+    """Return the time taken to call func, and its result."""
+    start = time.time()
+    result = func(*args, **kwds)
+    return (time.time() - start, result)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]",
+                          description="time sorting versions")
+    parser.add_option("-c", "--count", type="int", default=100000,
+                      help="Number of versions to sort [default: 100000]")
+    (options, args) = parser.parse_args()
+
+    rand = random.Random(20081006)
+    versions = [ random_version(rand) for i in range(options.count) ]
+    print("%d versions, %d distinct" % (len(versions), len(set(versions))))
+
+    clear_caches()
+    parsed = [ Version(ver) for ver in versions ]
+    (base, expected) = timed(sorted, parsed, cmp=reference_cmp)
+    print("%-26s %6.2fs" % ("deb_cmp, parsed", base))
+
+    same = True
+    for name, key, cold in (("Version, cold caches", Version, True),
+                            ("Version, warm caches", Version, False),
+                            ("version_key, warm caches", version_key, False)):
+        if cold:
+            clear_caches()
+        (elapsed, result) = timed(sorted, versions, key=key)
+        ordered = all(Version(x) == y for x, y in zip(result, expected))
+        same = same and ordered
+
+        print("%-26s %6.2fs  (%5.1fx)  %s"
+              % (name, elapsed, base / elapsed,
+                 "same order" if ordered else "DIFFERENT ORDER"))
+
+    return 0 if same else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_md5sum.py - check remembered checksums
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from hashlib import md5
+
+import momlib
+
+
+class MD5SumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "file")
+        self.saved = dict(momlib.MD5_CACHE)
+        momlib.MD5_CACHE.clear()
+
+    def tearDown(self):
+        momlib.MD5_CACHE.clear()
+        momlib.MD5_CACHE.update(self.saved)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        with open(self.filename, "r+b" if os.path.exists(self.filename)
+                  else "wb") as output:
+            output.write(data)
+        return md5(data).hexdigest()
+
+    def test_remembered(self):
+        """An unchanged file is only read once."""
+        expected = self.write("a" * 1000)
+        self.assertEqual(momlib.md5sum(self.filename), expected)
+
+        # Tamper with what's remembered to show it's what is returned
+        for key in momlib.MD5_CACHE:
+            momlib.MD5_CACHE[key] = "remembered"
+        st = os.stat(self.filename)
+        self.assertEqual(momlib.md5sum(self.filename, st), "remembered")
+
+    def test_rewritten(self):
+        """A file rewritten in place with its mtime put back is read again."""
+        self.write("a" * 1000)
+        os.utime(self.filename, (1000000000, 1000000000))
+        st = os.stat(self.filename)
+        momlib.md5sum(self.filename)
+
+        # Make sure the change time moves on
+        time.sleep(0.01)
+        expected = self.write("b" * 1000)
+        os.utime(self.filename, (1000000000, 1000000000))
+        new_st = os.stat(self.filename)
+        self.assertEqual((new_st.st_ino, new_st.st_size, new_st.st_mtime),
+                         (st.st_ino, st.st_size, st.st_mtime))
+
+        self.assertEqual(momlib.md5sum(self.filename), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_shell.py - check running child processes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import shutil
+import resource
+import tempfile
+import unittest
+
+from util import shell
+
+
+# Child that allocates and touches the given number of MiB, then waits for
+# its input to be closed before exiting
+ALLOCATE = "import sys; x = 'x' * (%d << 20); sys.stdin.read()"
+
+
+def maxrss():
+    """Return our maximum resident set size so far, in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+def forked_env():
+    """Return an environment that makes Process fork rather than spawn."""
+    env = dict(os.environ)
+    env["PATH"] = env.get("PATH", "") + ":/nonexistent"
+    return env
+
+
+class UsageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict(shell.USAGE)
+        shell.reset_usage()
+        shell.set_context("test")
+
+    def tearDown(self):
+        shell.set_context(None)
+        shell.reset_usage()
+        shell.USAGE.update(self.saved)
+
+    def allocate(self, size, **kwds):
+        """Run a child allocating size MiB, return the Process."""
+        process = shell.Process((sys.executable, "-c", ALLOCATE % size), "w",
+                                **kwds)
+        return process
+
+    def recorded(self):
+        """Return the maximum resident set size recorded, in MiB."""
+        return shell.USAGE[(os.path.basename(sys.executable),
+                            "test")]["maxrss"] // 1024
+
+    def check_larger(self, **kwds):
+        """Check a child larger than us is recorded, return the Process."""
+        size = maxrss() + 64
+        process = self.allocate(size, **kwds)
+        process.close()
+
+        self.assertTrue(self.recorded() >= size,
+                        "%d MiB < %d MiB" % (self.recorded(), size))
+        return process
+
+    def test_spawned_larger(self):
+        """A spawned child larger than us has its peak recorded."""
+        if shell._posix_spawnp is None:
+            self.skipTest("no posix_spawnp")
+
+        process = self.check_larger()
+        self.assertFalse(process.forked)
+
+    def test_forked_larger(self):
+        """A forked child larger than us has its peak recorded."""
+        process = self.check_larger(env=forked_env())
+        self.assertTrue(process.forked)
+
+    def test_smaller(self):
+        """A child smaller than us can't be told apart from our image."""
+        ballast = "x" * ((maxrss() + 128) << 20)
+        for env in (None, forked_env()):
+            self.allocate(32, env=env).close()
+            self.assertEqual(self.recorded(), 0)
+        del ballast
+
+    def test_grown_since(self):
+        """Our growing while the child runs doesn't hide its peak."""
+        process = self.allocate(64)
+        ballast = "x" * ((maxrss() + 128) << 20)
+        process.close()
+        del ballast
+
+        self.assertTrue(self.recorded() >= 64, "%d MiB" % self.recorded())
+
+
+class FallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = shell._posix_spawnp
+        shell._posix_spawnp = None
+
+    def tearDown(self):
+        shell._posix_spawnp = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def test_output(self):
+        """Without posix_spawnp, a child is forked and behaves the same."""
+        env = dict(os.environ)
+        env["FALLBACK"] = "forked"
+        process = shell.Process(("sh", "-c", "pwd; echo $FALLBACK; exit 3"),
+                                "r", chdir=self.tmpdir, env=env,
+                                okstatus=(3,))
+        output = process.read_all()
+        self.assertEqual(process.close(), 3)
+
+        self.assertTrue(process.forked)
+        self.assertEqual(output.split("\n"),
+                         [ os.path.realpath(self.tmpdir), "forked", "" ])
+
+    def test_status(self):
+        """Without posix_spawnp, failing children are still reported."""
+        self.assertRaises(ValueError, shell.run, ("false",))
+        self.assertRaises(OSError, shell.run,
+                          (os.path.join(self.tmpdir, "missing"),))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_sources.py - check the pre-parsed Sources cache
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+import momlib
+
+
+class SourcesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "Sources")
+        self.cache_filename = momlib.sources_cache_file(self.filename)
+
+        with open(self.filename, "w") as sources:
+            for i in range(10):
+                sources.write("Package: pkg%d\nVersion: 1.%d-1\n"
+                              "Binary: pkg%d\n\n" % (i, i, i))
+
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.tmpdir)
+
+    def check_paras(self, paras):
+        self.assertEqual([ para["Package"] for para in paras ],
+                         [ "pkg%d" % i for i in range(10) ])
+
+    def test_cache(self):
+        """The parsed file is cached, and the cache used next time."""
+        self.check_paras(momlib.read_sources(self.filename))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         [ "Sources", "Sources.cache" ])
+
+        # Rewriting the cache would rename a new file into place
+        inode = os.stat(self.cache_filename).st_ino
+        self.check_paras(momlib.read_sources(self.filename))
+        self.assertEqual(os.stat(self.cache_filename).st_ino, inode)
+
+    def test_corrupt(self):
+        """A cache that can't be unpickled is replaced."""
+        momlib.read_sources(self.filename)
+        with open(self.cache_filename, "rb") as cache:
+            data = cache.read()
+
+        for corrupt in ("", "garbage", data[:len(data) // 2],
+                        "cno.such.module\nthing\n."):
+            with open(self.cache_filename, "wb") as cache:
+                cache.write(corrupt)
+
+            self.check_paras(momlib.read_sources(self.filename))
+            with open(self.cache_filename, "rb") as cache:
+                self.assertEqual(cache.read(), data, repr(corrupt))
+
+    def test_unwritable(self):
+        """Failing to write the cache leaves nothing behind."""
+        os.chmod(self.tmpdir, 0555)
+        try:
+            if os.access(self.tmpdir, os.W_OK):
+                self.skipTest("running as root")
+            self.check_paras(momlib.read_sources(self.filename))
+        finally:
+            os.chmod(self.tmpdir, 0755)
+
+        self.assertEqual(os.listdir(self.tmpdir), [ "Sources" ])
+
+
+if __name__ == "__main__":
+    unittest.main()
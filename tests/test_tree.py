@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_tree.py - check copying trees
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from util import tree
+
+
+class CopyTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src")
+
+        for i in range(40):
+            dirname = os.path.join(self.src, "d%d" % (i % 4), "e%d" % (i % 3))
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(os.path.join(dirname, "f%d" % i), "wb") as data:
+                data.write(os.urandom(i * 1000))
+            os.chmod(os.path.join(dirname, "f%d" % i), 0640 | (i % 2))
+        os.symlink("d0/e0", os.path.join(self.src, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_copy(self, dst):
+        """Check the copy matches the source."""
+        self.assertEqual(sorted(tree.walk(dst)), sorted(tree.walk(self.src)))
+        for filename in tree.walk(self.src):
+            srcpath = os.path.join(self.src, filename)
+            dstpath = os.path.join(dst, filename)
+            if os.path.islink(srcpath):
+                self.assertEqual(os.readlink(dstpath), os.readlink(srcpath))
+            elif os.path.isfile(srcpath):
+                with open(srcpath, "rb") as src:
+                    with open(dstpath, "rb") as copy:
+                        self.assertEqual(copy.read(), src.read(), filename)
+                self.assertEqual(os.stat(dstpath).st_mode,
+                                 os.stat(srcpath).st_mode, filename)
+                self.assertNotEqual(os.stat(dstpath).st_ino,
+                                    os.stat(srcpath).st_ino, filename)
+
+    def test_copytree(self):
+        """A tree is copied one file at a time."""
+        dst = os.path.join(self.tmpdir, "dst")
+        tree.copytree(self.src, dst)
+        self.check_copy(dst)
+
+    def test_copytree_jobs(self):
+        """A tree is copied with several files at once."""
+        threads = set()
+        copy2 = tree.copy2
+        def record_copy2(srcpath, dstpath):
+            threads.add(threading.current_thread().ident)
+            copy2(srcpath, dstpath)
+
+        tree.copy2 = record_copy2
+        try:
+            dst = os.path.join(self.tmpdir, "dst")
+            tree.copytree(self.src, dst, jobs=4)
+        finally:
+            tree.copy2 = copy2
+
+        self.check_copy(dst)
+        self.assertNotIn(threading.current_thread().ident, threads)
+        self.assertTrue(1 <= len(threads) <= 4, threads)
+
+    def test_copytree_jobs_error(self):
+        """A copy that fails in a pool thread is raised by copytree."""
+        # Only reached through the link, which is copied on the pool
+        fifo = os.path.join(self.tmpdir, "fifo")
+        os.mkfifo(fifo)
+        os.symlink(fifo, os.path.join(self.src, "d1", "to-fifo"))
+
+        dst = os.path.join(self.tmpdir, "dst")
+        self.assertRaises(shutil.SpecialFileError, tree.copytree,
+                          self.src, dst, dereference=True, jobs=4)
+
+    def test_size_hardlinks(self):
+        """Files hardlinked within a tree are counted once."""
+        total = tree.size(self.src)
+
+        dst = os.path.join(self.tmpdir, "dst")
+        tree.copytree(self.src, dst, link=True)
+        self.assertEqual(tree.size(dst), total)
+
+        # Everything is shared with the source, bar the directories
+        unshared = sum(os.lstat(os.path.join(dst, filename)).st_size
+                       for filename in tree.walk(dst)
+                       if not os.path.isfile(os.path.join(dst, filename))
+                       or os.path.islink(os.path.join(dst, filename)))
+        self.assertEqual(tree.size(dst, shared=False), unshared)
+
+        os.link(os.path.join(self.src, "d0", "e0", "f0"),
+                os.path.join(self.src, "f0"))
+        self.assertEqual(tree.size(self.src), total)
+
+    def count_stats(self, func, *args):
+        """Return the number of stat calls made by func, and its result."""
+        calls = []
+        def counted(func):
+            def wrapper(*args):
+                calls.append(args)
+                return func(*args)
+            return wrapper
+
+        (lstat, stat) = (os.lstat, os.stat)
+        os.lstat = counted(lstat)
+        os.stat = counted(stat)
+        try:
+            result = func(*args)
+        finally:
+            (os.lstat, os.stat) = (lstat, stat)
+
+        return (len(calls), result)
+
+    def test_walk_stat_calls(self):
+        """Walking with stat results needs fewer stat calls."""
+        def walk_lstat(path):
+            return [ (filename, os.lstat(os.path.join(path, filename)))
+                     for filename in tree.walk(path) ]
+        (walk_calls, expected) = self.count_stats(walk_lstat, self.src)
+        (calls, entries) = self.count_stats(list, tree.walk_stat(self.src))
+
+        self.assertEqual(sorted(entries), sorted(expected))
+        # One lstat for each entry at most, fewer where scandir gives them
+        self.assertTrue(calls <= len(entries), calls)
+        self.assertTrue(calls < walk_calls, (calls, walk_calls))
+
+    def test_special_file(self):
+        """Special files are refused rather than opened."""
+        fifo = os.path.join(self.tmpdir, "fifo")
+        os.mkfifo(fifo)
+        self.assertRaises(shutil.SpecialFileError, tree.copy2,
+                          fifo, os.path.join(self.tmpdir, "copy"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_unpack_cache.py - check locking of unpacked sources
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+
+import momlib
+from util import tree
+
+
+class UnpackCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved = (momlib.ROOT, momlib.UNPACK_TOTAL)
+        momlib.ROOT = self.tmpdir
+        momlib.UNPACK_TOTAL = None
+
+        self.destdir = os.path.join(self.tmpdir, "unpacked/main/p/p-1.0")
+        self.log = os.path.join(self.tmpdir, "extracted")
+
+    def tearDown(self):
+        (momlib.ROOT, momlib.UNPACK_TOTAL) = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def extract(self, destdir):
+        """Extract a tree slowly, noting that it was done."""
+        with open(self.log, "a") as log:
+            log.write("%d\n" % os.getpid())
+        time.sleep(0.2)
+        os.makedirs(destdir)
+        with open(os.path.join(destdir, "file"), "w") as data:
+            data.write("x" * 1000)
+
+    def fail(self, destdir):
+        os.makedirs(destdir)
+        raise ValueError, "extraction failed"
+
+    def in_child(self, func):
+        """Call func in a child process, return its exit status."""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                signal.alarm(10)
+                func()
+                status = 0
+            finally:
+                os._exit(status)
+
+        return os.waitpid(pid, 0)[1]
+
+    def lock(self):
+        (stamp, extracted) = momlib.lock_unpacked(self.destdir, "key",
+                                                  self.extract)
+        stamp.close()
+
+    def extractions(self):
+        with open(self.log) as log:
+            return len(log.readlines())
+
+    def test_extract_once(self):
+        """Concurrent users extract the tree only once."""
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.alarm(10)
+                    self.lock()
+                    status = 0
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+
+        statuses = [ os.waitpid(pid, 0)[1] for pid in pids ]
+        self.assertEqual(statuses, [ 0 ] * len(pids))
+
+        self.assertEqual(self.extractions(), 1)
+        with open(momlib.unpack_stamp_file(self.destdir)) as stamp:
+            self.assertEqual(stamp.read(),
+                             "key %d\n" % tree.size(self.destdir))
+
+    def test_shared_hit(self):
+        """A tree in use by one process can be used by another at once."""
+        (stamp, extracted) = momlib.lock_unpacked(self.destdir, "key",
+                                                  self.extract)
+        try:
+            self.assertTrue(extracted)
+
+            # Blocking on our lock would run into the alarm
+            def hit():
+                signal.alarm(1)
+                self.lock()
+            self.assertEqual(self.in_child(hit), 0)
+        finally:
+            stamp.close()
+
+        self.assertEqual(self.extractions(), 1)
+
+    def test_stale(self):
+        """A tree with a different key is extracted again."""
+        self.lock()
+        (stamp, extracted) = momlib.lock_unpacked(self.destdir, "other",
+                                                  self.extract)
+        stamp.close()
+
+        self.assertTrue(extracted)
+        self.assertEqual(self.extractions(), 2)
+
+    def test_failed(self):
+        """A failed extraction leaves neither tree nor stamp behind."""
+        self.assertRaises(ValueError, momlib.lock_unpacked,
+                          self.destdir, "key", self.fail)
+        self.assertFalse(os.path.exists(self.destdir))
+        self.assertFalse(os.path.exists(
+            momlib.unpack_stamp_file(self.destdir)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_update_pool.py - download a pool from a fake mirror
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import os
+import re
+import socket
+import imp
+import gzip
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+from hashlib import md5, sha256
+
+import momlib
+
+
+update_pool = imp.load_source("update_pool", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "update-pool.py"))
+
+# Number of packages on the fake mirror, each has an orig tarball and dsc
+PACKAGES = 20
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve files from the fake mirror, keeping count of the traffic.
+
+    Files named in the server's drops have the connection closed half way
+    through sending them that many times, and if the server's
+    ignore_range is set, Range requests are answered with the whole file.
+    """
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = 1 << 16
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path,
+                                         self.headers.getheader("Range")))
+
+        filename = self.server.mirror + self.path
+        if not os.path.isfile(filename):
+            self.send_empty(404)
+            return
+
+        with open(filename, "rb") as data:
+            body = data.read()
+
+        match = re.match(r'bytes=(\d+)-$', self.headers.getheader("Range", ""))
+        if match is not None and not self.server.ignore_range:
+            start = int(match.group(1))
+            if start >= len(body):
+                self.send_empty(416)
+                return
+
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d"
+                             % (start, len(body) - 1, len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        name = os.path.basename(self.path)
+        with self.server.lock:
+            drop = self.server.drops.get(name, 0) > 0
+            if drop:
+                self.server.drops[name] -= 1
+
+        if drop:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = 1
+        else:
+            self.wfile.write(body)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Fake mirror serving the directory given."""
+
+    daemon_threads = True
+
+    def __init__(self, mirror):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           MirrorHandler)
+        self.mirror = mirror
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.drops = {}
+        self.ignore_range = False
+
+
+class Options(object):
+    """Command-line options for update-pool."""
+
+    def __init__(self, jobs):
+        self.package = None
+        self.jobs = jobs
+
+
+class UpdatePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(20081006)
+        self.tmpdir = tempfile.mkdtemp()
+        self.mirror = os.path.join(self.tmpdir, "mirror")
+        self.root = os.path.join(self.tmpdir, "root")
+
+        self.server = MirrorServer(self.mirror)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.saved = (momlib.ROOT, dict(momlib.DISTROS))
+        momlib.ROOT = update_pool.ROOT = self.root
+        momlib.DISTROS.clear()
+        momlib.DISTROS["fake"] = {
+            "mirror": "http://127.0.0.1:%d/debian" % self.server.server_port,
+            "dists": [ "sid" ],
+            "components": [ "main" ],
+            "expire": False,
+            }
+
+        self.files = {}
+
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        update_pool.close_connections()
+
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+        (momlib.ROOT, distros) = self.saved
+        update_pool.ROOT = momlib.ROOT
+        momlib.DISTROS.clear()
+        momlib.DISTROS.update(distros)
+
+        shutil.rmtree(self.tmpdir)
+
+    def make_mirror(self, bad_sha256=(), bad_md5=()):
+        """Create the mirror's Sources and pool files.
+
+        Packages named in bad_sha256 or bad_md5 are listed with the wrong
+        checksum for their orig tarball.
+        """
+        paras = []
+        for i in range(PACKAGES):
+            package = "pkg%02d" % i
+            directory = "pool/main/p/%s" % package
+            os.makedirs(os.path.join(self.mirror, "debian", directory))
+
+            md5sums = []
+            sha256sums = []
+            for name, size in (("%s_1.0.orig.tar.gz" % package,
+                                self.random.randint(1000, 200000)),
+                               ("%s_1.0-1.dsc" % package, 800)):
+                data = os.urandom(size)
+                filename = os.path.join(self.mirror, "debian", directory,
+                                        name)
+                with open(filename, "wb") as output:
+                    output.write(data)
+                self.files[name] = (package, data)
+
+                md5sum = md5(data).hexdigest()
+                sha256sum = sha256(data).hexdigest()
+                if name.endswith(".orig.tar.gz"):
+                    if package in bad_md5:
+                        md5sum = md5(data + "x").hexdigest()
+                    if package in bad_sha256:
+                        sha256sum = sha256(data + "x").hexdigest()
+
+                md5sums.append(" %s %d %s" % (md5sum, size, name))
+                sha256sums.append(" %s %d %s" % (sha256sum, size, name))
+
+            paras.append("Package: %s\nVersion: 1.0-1\nDirectory: %s\n"
+                         "Files:\n%s\nChecksums-Sha256:\n%s\n"
+                         % (package, directory, "\n".join(md5sums),
+                            "\n".join(sha256sums)))
+
+        sources = os.path.join(self.mirror, "debian/dists/sid/main/source")
+        os.makedirs(sources)
+        with open(os.path.join(sources, "Sources.gz"), "wb") as output:
+            gzfile = gzip.GzipFile(fileobj=output, mode="wb")
+            gzfile.write("\n".join(paras))
+            gzfile.close()
+
+    def pool_file(self, name):
+        """Return the location of a file in our pool."""
+        package = self.files[name][0]
+        return os.path.join(self.root, momlib.pool_directory("fake", package),
+                            name)
+
+    def make_partial(self, name, data=None):
+        """Leave the first half of a file, or data, as a partial download."""
+        if data is None:
+            data = self.files[name][1]
+            data = data[:len(data) // 2]
+
+        filename = self.pool_file(name) + ".partial"
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, "wb") as partial:
+            partial.write(data)
+
+        return len(data)
+
+    def requested(self, name):
+        """Return the Range headers of the requests made for a file."""
+        return [ header for path, header in self.server.requests
+                 if os.path.basename(path) == name ]
+
+    def update_pool(self, jobs=4):
+        """Run update-pool against the fake mirror."""
+        return update_pool.main(Options(jobs), [ "fake" ])
+
+    def check_pool(self, missing=()):
+        """Check every file other than those missing is in our pool."""
+        for name, (package, data) in self.files.items():
+            filename = self.pool_file(name)
+            self.assertFalse(os.path.exists(filename + ".partial"), name)
+            if name in missing:
+                self.assertFalse(os.path.exists(filename), name)
+            else:
+                with open(filename, "rb") as pool_file:
+                    self.assertEqual(pool_file.read(), data, name)
+
+    def test_pool(self):
+        """Every file on the mirror is downloaded into the pool."""
+        self.make_mirror()
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+
+        # A second run finds nothing more to do
+        del self.server.requests[:]
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_bad_sha256(self):
+        """A file whose SHA256 checksum doesn't match isn't kept."""
+        self.make_mirror(bad_sha256=("pkg03",))
+        self.assertEqual(self.update_pool(),
+                         update_pool.DOWNLOAD_FAILED_STATUS)
+        self.check_pool(missing=("pkg03_1.0.orig.tar.gz",))
+
+    def test_bad_md5(self):
+        """A file whose MD5 checksum doesn't match isn't kept."""
+        self.make_mirror(bad_md5=("pkg05",))
+        self.assertEqual(self.update_pool(),
+                         update_pool.DOWNLOAD_FAILED_STATUS)
+        self.check_pool(missing=("pkg05_1.0.orig.tar.gz",))
+
+    def test_connection_reuse(self):
+        """Each download thread keeps a single connection to the mirror."""
+        self.make_mirror()
+        self.update_pool(jobs=2)
+        self.check_pool()
+
+        # One for the Sources file, and one for each download thread
+        self.assertEqual(len(self.server.requests), 2 * PACKAGES + 1)
+        self.assertTrue(self.server.connections <= 3,
+                        "%d connections" % self.server.connections)
+
+    def test_resume(self):
+        """Partial downloads are carried on from where they stopped."""
+        self.make_mirror()
+        names = [ "pkg%02d_1.0.orig.tar.gz" % i for i in range(4) ]
+        lengths = [ self.make_partial(name) for name in names ]
+
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        for name, length in zip(names, lengths):
+            self.assertEqual(self.requested(name), [ "bytes=%d-" % length ])
+
+    def test_resume_bad_partial(self):
+        """A partial download that doesn't match is started again."""
+        self.make_mirror()
+        name = "pkg01_1.0.orig.tar.gz"
+        length = self.make_partial(name, "x" * 500)
+
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        self.assertEqual(self.requested(name), [ "bytes=%d-" % length, None ])
+
+    def test_resume_complete_partial(self):
+        """A partial download that is already complete isn't requested."""
+        self.make_mirror()
+        name = "pkg01_1.0.orig.tar.gz"
+        self.make_partial(name, self.files[name][1])
+
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        self.assertEqual(self.requested(name), [])
+
+    def test_dropped(self):
+        """A download cut off part way through is resumed."""
+        self.make_mirror()
+        name = "pkg02_1.0.orig.tar.gz"
+        length = len(self.files[name][1]) // 2
+        self.server.drops[name] = 1
+
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        self.assertEqual(self.requested(name), [ None, "bytes=%d-" % length ])
+
+    def test_dropped_repeatedly(self):
+        """A download cut off too often is failed and resumed next time."""
+        self.make_mirror()
+        name = "pkg02_1.0.orig.tar.gz"
+        self.server.drops[name] = update_pool.DOWNLOAD_RETRIES + 1
+
+        self.assertEqual(self.update_pool(),
+                         update_pool.DOWNLOAD_FAILED_STATUS)
+        filename = self.pool_file(name)
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(os.path.getsize(filename + ".partial") > 0)
+
+        del self.server.requests[:]
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        self.assertEqual(len(self.requested(name)), 1)
+        self.assertNotEqual(self.requested(name), [ None ])
+
+    def test_ignored_range(self):
+        """A mirror that sends the whole file replaces the partial one."""
+        self.make_mirror()
+        self.server.ignore_range = True
+        names = [ "pkg%02d_1.0.orig.tar.gz" % i for i in range(4) ]
+        for name in names:
+            self.make_partial(name)
+        self.make_partial("pkg04_1.0.orig.tar.gz", "x" * 500)
+
+        self.assertFalse(self.update_pool())
+        self.check_pool()
+        for name in names:
+            self.assertEqual(len(self.requested(name)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
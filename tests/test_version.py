@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_version.py - check version keys against deb_cmp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import unittest
+
+from deb.version import Version, version_key, deb_cmp
+
+
+# Characters to build version components from; digits and "~" are
+# weighted up as they're where the interesting orderings are
+ALPHABET = "0123456789" * 3 + "~~~" + "aAzZ+."
+
+# Number of random pairs to compare
+PAIRS = 20000
+
+
+def reference_cmp(x, y):
+    """Compare two versions the way Version did before it had keys."""
+    result = cmp(x.epoch, y.epoch)
+    if result != 0: return result
+
+    result = deb_cmp(x.upstream, y.upstream)
+    if result != 0: return result
+
+    return deb_cmp(x.revision or "", y.revision or "")
+
+def sign(value):
+    """Return -1, 0 or 1 for the sign of value."""
+    return cmp(value, 0)
+
+
+class VersionKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(20081006)
+
+    def random_part(self, chars):
+        """Return a random version component made of chars."""
+        part = "".join(self.random.choice(chars)
+                       for i in range(self.random.randint(0, 6)))
+        if self.random.random() < 0.1:
+            part += "0" * self.random.randint(0, 3) \
+                    + self.random.choice("123456789") * 300
+        return part
+
+    def random_version(self):
+        """Return a random valid version string."""
+        ver = self.random.choice("0123456789") + self.random_part(ALPHABET)
+        if self.random.random() < 0.5:
+            ver += "-" + self.random.choice("0123456789") \
+                   + self.random_part(ALPHABET)
+        if self.random.random() < 0.3:
+            ver = "%d:%s" % (self.random.randint(0, 3), ver)
+        return ver
+
+    def check(self, x, y):
+        """Check that the key orders x and y the same as deb_cmp."""
+        vx = Version(x)
+        vy = Version(y)
+        expected = sign(reference_cmp(vx, vy))
+
+        self.assertEqual(sign(cmp(vx, vy)), expected, (x, y))
+        self.assertEqual(sign(cmp(version_key(x), version_key(y))),
+                         expected, (x, y))
+        if expected == 0:
+            self.assertEqual(hash(vx), hash(vy), (x, y))
+
+    def test_random_pairs(self):
+        """Random pairs of versions compare the same as with deb_cmp."""
+        for i in range(PAIRS):
+            self.check(self.random_version(), self.random_version())
+
+    def test_similar_pairs(self):
+        """Versions differing by one character compare correctly."""
+        for i in range(PAIRS):
+            x = self.random_version()
+            idx = self.random.randint(0, len(x))
+            y = x[:idx] + self.random.choice("0159~a.+") + x[idx:]
+            try:
+                Version(y)
+            except ValueError:
+                continue
+            self.check(x, y)
+
+    def test_known_order(self):
+        """Versions from Debian policy sort in the expected order."""
+        versions = [ "1.0~rc1-1", "1.0-1~bpo1", "1.0-1", "1.0-1ubuntu1",
+                     "1.0-1.1", "1.0+dfsg-1", "1.0.1-1", "1.1-0ubuntu1",
+                     "1.1-1", "1.10-1", "2.0~~-1", "2.0~-1", "2.0-1",
+                     "1:0.9-1" ]
+        shuffled = list(versions)
+        self.random.shuffle(shuffled)
+        self.assertEqual(sorted(shuffled, key=version_key), versions)
+
+    def test_long_digit_runs(self):
+        """Runs of more than 255 digits are compared by value."""
+        self.check("1" * 300, "2" + "0" * 299)
+        self.check("1" * 300, "9" * 299)
+        self.check("0" * 300 + "1", "1")
+        self.check("1.%s-1" % ("5" * 256), "1.%s-1" % ("5" * 255))
+        self.check("%s:1" % ("1" * 260), "2:1")
+
+
+if __name__ == "__main__":
+    unittest.main()
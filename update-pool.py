@@ -21,19 +21,60 @@ from __future__ import with_statement
 
 import os
 import gzip
+import socket
 import urllib
+import httplib
+import urlparse
 import logging
 import tempfile
+import threading
+try:
+    from hashlib import sha256
+except ImportError:
+    sha256 = None
 from contextlib import closing
 
 from momlib import *
-from util import tree
+from util import shell, tree
+
+
+# Number of files downloaded at once
+DOWNLOAD_JOBS = 4
+
+# Seconds to wait on a mirror that has stopped responding
+DOWNLOAD_TIMEOUT = 60
+
+# Size of the blocks downloads are read, written and checksummed in
+DOWNLOAD_BLOCK_SIZE = 1 << 16
+
+# Number of redirects followed for one download
+DOWNLOAD_REDIRECTS = 5
+
+# Number of times a download that was cut off is resumed in the same run
+DOWNLOAD_RETRIES = 2
+
+# Persistent connections to mirrors, each download thread has its own
+CONNECTIONS = threading.local()
+
+# Exit status when some downloads failed but everything else was done
+DOWNLOAD_FAILED_STATUS = 2
+
+
+class HTTPError(IOError):
+    """Mirror answered a request with an error."""
+
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, "%s: %d %s" % (url, status, reason))
+        self.status = status
 
 
 def options(parser):
     parser.add_option("-p", "--package", type="string", metavar="PACKAGE",
                       action="append",
                       help="Process only theses packages")
+    parser.add_option("-j", "--jobs", type="int", metavar="N",
+                      default=DOWNLOAD_JOBS,
+                      help="Download up to N files at once")
 
 def main(options, args):
     if len(args):
@@ -43,13 +84,14 @@ def main(options, args):
 
     # Download the current sources for the given distributions and download
     # any new contents into our pool
+    failed = 0
     for distro in distros:
         for dist in DISTROS[distro]["dists"]:
             for component in DISTROS[distro]["components"]:
                 update_sources(distro, dist, component)
 
-                sources = get_sources(distro, dist, component)
-                for source in sources:
+                downloads = {}
+                for source in iter_sources(distro, dist, component):
                     if options.package is not None \
                            and source["Package"] not in options.package:
                         continue
@@ -59,7 +101,16 @@ def main(options, args):
                         # It looks as though we've already processed and
                         # expired this.
                         continue
-                    update_pool(distro, source)
+                    for download in pool_downloads(distro, source):
+                        downloads[download[1]] = download
+
+                failed += download_files(sorted(downloads.values()),
+                                         options.jobs)
+
+    if failed:
+        logging.error("%d downloads failed, any part downloaded will be "
+                      "resumed next time", failed)
+        return DOWNLOAD_FAILED_STATUS
 
 
 def sources_url(distro, dist, component):
@@ -88,17 +139,27 @@ def update_sources(distro, dist, component):
     finally:
         os.unlink(gzfilename)
 
+    # The next get_sources() call will notice the new file and rebuild
+    # the pre-parsed cache shared by the later stages
+    forget_sources(distro, dist, component)
+
     logging.info("Saved %s", tree.subdir(ROOT, filename))
     return filename
 
-def update_pool(distro, source):
-    """Download a source package into our pool."""
+def pool_downloads(distro, source):
+    """Return the downloads needed to bring a source package into our pool.
+
+    Each is a (url, filename, size, md5sum, sha256sum) tuple, sha256sum
+    being None if the Sources file doesn't give one.
+    """
     mirror = DISTROS[distro]["mirror"]
     sourcedir = source["Directory"]
 
     pooldir = pool_directory(distro, source["Package"])
+    sha256s = sha256sums(source)
 
-    for md5sum, size, name in files(source):
+    downloads = []
+    for checksum, size, name in files(source):
         url = "%s/%s/%s" % (mirror, sourcedir, name)
         filename = "%s/%s/%s" % (ROOT, pooldir, name)
 
@@ -106,14 +167,224 @@ def update_pool(distro, source):
             if os.path.getsize(filename) == int(size):
                 continue
 
-        logging.debug("Downloading %s", url)
-        ensure(filename)
+        downloads.append((url, filename, int(size), checksum,
+                          sha256s.get(name)))
+
+    return downloads
+
+def download_files(downloads, jobs):
+    """Download files into our pool, up to jobs at once.
+
+    Takes a list of downloads as returned by pool_downloads().  A failed
+    download is logged and the rest carry on; returns the number that
+    failed.
+    """
+    failed = 0
+    with shell.Pool(jobs) as pool:
+        results = []
+        for url, filename, size, checksum, sha256sum in downloads:
+            logging.debug("Downloading %s", url)
+            ensure(filename)
+            job = pool.submit(download_file, url, filename, size, checksum,
+                              sha256sum)
+            results.append((url, filename, job))
+
+        for url, filename, job in results:
+            try:
+                job.result()
+            except (IOError, OSError, httplib.HTTPException), e:
+                logging.error("Downloading %s failed: %s", url, e)
+                failed += 1
+            else:
+                logging.info("Saved %s", tree.subdir(ROOT, filename))
+
+    return failed
+
+def download_file(url, filename, size, checksum, sha256sum=None):
+    """Download a file into our pool.
+
+    The file is written to filename.partial, which is kept if the
+    download is cut off so that it can be resumed from where it stopped,
+    both here and by later runs.  Only once the size and checksums of the
+    whole file match those given is it renamed into place; so a file in
+    the pool is always complete.
+    """
+    partial = filename + ".partial"
+
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        retry = attempt < DOWNLOAD_RETRIES
         try:
-            urllib.URLopener().retrieve(url, filename)
-        except IOError:
-            logging.error("Downloading %s failed", url)
+            (resumed, md5_hash, sha256_hash) \
+                = fetch_partial(url, partial, size, sha256sum is not None)
+        except HTTPError, e:
+            if e.status == 416:
+                # Whatever we have doesn't fit the file on the mirror
+                tree.remove(partial)
+                if retry:
+                    continue
+            raise
+        except (socket.error, httplib.HTTPException):
+            if retry:
+                continue
             raise
-        logging.info("Saved %s", tree.subdir(ROOT, filename))
+
+        if os.path.getsize(partial) != size:
+            error = "Size mismatch for %s" % url
+        elif md5_hash.hexdigest() != checksum:
+            error = "Checksum mismatch for %s" % url
+        elif sha256_hash is not None and sha256_hash.hexdigest() != sha256sum:
+            error = "SHA256 checksum mismatch for %s" % url
+        else:
+            os.rename(partial, filename)
+            return
+
+        # The part we had may have been bad, if so start again
+        tree.remove(partial)
+        if not (resumed and retry):
+            raise IOError, error
+
+def fetch_partial(url, partial, size, want_sha256):
+    """Download the rest of a file into its partial file.
+
+    Whatever is already in the partial file is checksummed and only the
+    rest of the file requested from the mirror, if it sends the whole
+    file instead that replaces it.  Returns whether the download carried
+    on from an earlier one, and the MD5 and (if wanted and available)
+    SHA256 hashes of the partial file's contents.
+    """
+    md5_hash = md5()
+    if want_sha256 and sha256 is not None:
+        sha256_hash = sha256()
+    else:
+        sha256_hash = None
+
+    try:
+        length = os.path.getsize(partial)
+    except OSError:
+        length = 0
+
+    if length > size:
+        tree.remove(partial)
+        length = 0
+    elif length > 0:
+        with open(partial, "rb") as existing:
+            while True:
+                block = existing.read(DOWNLOAD_BLOCK_SIZE)
+                if not len(block):
+                    break
+
+                md5_hash.update(block)
+                if sha256_hash is not None:
+                    sha256_hash.update(block)
+
+        if length == size:
+            return (True, md5_hash, sha256_hash)
+
+    if length > 0:
+        response = open_url(url, { "Range": "bytes=%d-" % length })
+    else:
+        response = open_url(url)
+
+    if response.status == 206 and response.getheader("Content-Range", "") \
+           .startswith("bytes %d-" % length):
+        mode = "ab"
+    elif response.status == 206:
+        response.read()
+        raise HTTPError(url, 416, "Unexpected range")
+    else:
+        mode = "wb"
+        length = 0
+        md5_hash = md5()
+        if sha256_hash is not None:
+            sha256_hash = sha256()
+
+    try:
+        received = 0
+        with open(partial, mode) as output:
+            while True:
+                block = response.read(DOWNLOAD_BLOCK_SIZE)
+                if not len(block):
+                    break
+
+                output.write(block)
+                md5_hash.update(block)
+                if sha256_hash is not None:
+                    sha256_hash.update(block)
+                received += len(block)
+
+        # httplib returns what it got if the connection is closed early
+        expected = response.getheader("Content-Length")
+        if expected is not None and received < int(expected):
+            raise httplib.IncompleteRead("%d bytes" % received,
+                                         int(expected) - received)
+    except:
+        # Part of the response is left unread
+        close_connections()
+        raise
+
+    return (mode == "ab", md5_hash, sha256_hash)
+
+def open_url(url, headers={}):
+    """Request a URL over a persistent connection.
+
+    Redirects are followed, any other status than success (or partial
+    content) raises HTTPError.  Returns the response, which must be read
+    to the end before this thread makes another request of the same host.
+    """
+    for redirect in range(DOWNLOAD_REDIRECTS + 1):
+        (scheme, host, path, query, fragment) = urlparse.urlsplit(url)
+        if len(query):
+            path += "?" + query
+
+        response = request(scheme, host, path, headers)
+        if response.status in (301, 302, 303, 307, 308):
+            response.read()
+            url = urlparse.urljoin(url, response.getheader("Location"))
+        elif response.status not in (200, 206):
+            response.read()
+            raise HTTPError(url, response.status, response.reason)
+        else:
+            return response
+
+    raise IOError, "%s: too many redirects" % url
+
+def request(scheme, host, path, headers={}):
+    """Make a GET request of a host.
+
+    This thread's connection to the host is used if it has one, if the
+    server has since closed that it's replaced by a new connection.
+    """
+    if not hasattr(CONNECTIONS, "hosts"):
+        CONNECTIONS.hosts = {}
+
+    while True:
+        conn = CONNECTIONS.hosts.get((scheme, host))
+        fresh = conn is None
+        if fresh:
+            if scheme == "http":
+                conn = httplib.HTTPConnection(host, timeout=DOWNLOAD_TIMEOUT)
+            elif scheme == "https":
+                conn = httplib.HTTPSConnection(host, timeout=DOWNLOAD_TIMEOUT)
+            else:
+                raise IOError, "unsupported URL scheme: %s" % scheme
+            CONNECTIONS.hosts[(scheme, host)] = conn
+
+        try:
+            # Responses may be buffered as requests aren't pipelined
+            conn.request("GET", path, headers=headers)
+            return conn.getresponse(buffering=True)
+        except (IOError, httplib.HTTPException):
+            conn.close()
+            del CONNECTIONS.hosts[(scheme, host)]
+            if fresh:
+                raise
+
+def close_connections():
+    """Close this thread's connections."""
+    for conn in getattr(CONNECTIONS, "hosts", {}).values():
+        conn.close()
+
+    CONNECTIONS.hosts = {}
 
 
 if __name__ == "__main__":
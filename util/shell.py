@@ -21,7 +21,111 @@ from __future__ import print_function, with_statement
 
 import os
 import sys
+import time
+import errno
+import fcntl
+import select
 import signal
+import ctypes
+import resource
+import ctypes.util
+import threading
+import multiprocessing
+
+from Queue import Queue
+
+
+# posix_spawnattr_setflags() flags from <spawn.h>, to put the process in
+# the posix_spawnattr_setpgroup() group and to reset the signals in the
+# posix_spawnattr_setsigdefault() set to their default action
+POSIX_SPAWN_SETPGROUP = 0x02
+POSIX_SPAWN_SETSIGDEF = 0x04
+
+# Sizes of the opaque posix_spawn_file_actions_t, posix_spawnattr_t and
+# sigset_t types, rounded well up from glibc's
+SPAWN_FILE_ACTIONS_SIZE = 256
+SPAWNATTR_SIZE = 1024
+SIGSET_SIZE = 256
+
+# Resource usage of reaped child processes, by (command, context)
+USAGE = {}
+USAGE_LOCK = threading.Lock()
+
+# Context recorded alongside usage, normally the package being worked on;
+# each thread has its own, pool threads take that of the job's submitter
+USAGE_CONTEXT = threading.local()
+
+# Resource limits that may be given to a process, by name
+LIMIT_RESOURCES = {
+    "as": resource.RLIMIT_AS,
+    "cpu": resource.RLIMIT_CPU,
+    }
+
+# Timeout and resource limits for commands not given their own, by command
+# name (eg. { "diff": { "timeout": 600, "as": 1 << 30 } })
+DEFAULT_LIMITS = {}
+
+# Shortest and longest intervals between checks on a process with a timeout
+WAIT_POLL_MIN = 0.0005
+WAIT_POLL_MAX = 0.1
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+    _libc = None
+
+_posix_spawnp = getattr(_libc, "posix_spawnp", None)
+if _posix_spawnp is not None:
+    _posix_spawnp.argtypes = ( ctypes.POINTER(ctypes.c_int), ctypes.c_char_p,
+                               ctypes.c_void_p, ctypes.c_void_p,
+                               ctypes.c_void_p, ctypes.c_void_p )
+    _posix_spawnp.restype = ctypes.c_int
+
+    _spawn_funcs = {}
+    for name, argtypes in (
+        ("posix_spawn_file_actions_init", ( ctypes.c_void_p, )),
+        ("posix_spawn_file_actions_destroy", ( ctypes.c_void_p, )),
+        ("posix_spawn_file_actions_adddup2", ( ctypes.c_void_p, ctypes.c_int,
+                                               ctypes.c_int )),
+        ("posix_spawn_file_actions_addopen", ( ctypes.c_void_p, ctypes.c_int,
+                                               ctypes.c_char_p, ctypes.c_int,
+                                               ctypes.c_uint )),
+        ("posix_spawn_file_actions_addchdir_np", ( ctypes.c_void_p,
+                                                   ctypes.c_char_p )),
+        ("posix_spawnattr_init", ( ctypes.c_void_p, )),
+        ("posix_spawnattr_destroy", ( ctypes.c_void_p, )),
+        ("posix_spawnattr_setflags", ( ctypes.c_void_p, ctypes.c_short )),
+        ("posix_spawnattr_setpgroup", ( ctypes.c_void_p, ctypes.c_int )),
+        ("posix_spawnattr_setsigdefault", ( ctypes.c_void_p,
+                                            ctypes.c_void_p )),
+        ("sigemptyset", ( ctypes.c_void_p, )),
+        ("sigaddset", ( ctypes.c_void_p, ctypes.c_int ))):
+        func = getattr(_libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_int
+        _spawn_funcs[name] = func
+
+    # Directory changes need glibc 2.29, everything else is much older
+    if None in [ func for name, func in _spawn_funcs.items()
+                 if not name.endswith("_np") ]:
+        _posix_spawnp = None
+
+
+class _rlimit(ctypes.Structure):
+    _fields_ = [ ("rlim_cur", ctypes.c_uint64),
+                 ("rlim_max", ctypes.c_uint64) ]
+
+_prlimit = getattr(_libc, "prlimit64", None)
+if _prlimit is not None:
+    _prlimit.argtypes = ( ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(_rlimit), ctypes.POINTER(_rlimit) )
+    _prlimit.restype = ctypes.c_int
+
+
+class TimeoutExpired(OSError):
+    """Process killed for running longer than its timeout."""
+    pass
 
 
 class Process(object):
@@ -43,7 +147,8 @@ class Process(object):
     """
 
     def __init__(self, args, mode="x", stdin=None, stdout=None, stderr=None,
-                 chdir=None, okstatus=(0,), env=None):
+                 chdir=None, okstatus=(0,), env=None, timeout=None,
+                 limits=None):
         """Spawn a child process.
 
         The command name and its arguments should be provided as a tuple or
@@ -87,10 +192,34 @@ class Process(object):
         env argument.  This should normally be a copy of os.environ with
         additional changes.  If not passed or None, the child inherits the
         parent's environment.
+
+        A process may be given a timeout in seconds, if it's still running
+        after that it's killed along with any processes it started and
+        close() raises TimeoutExpired (a kind of OSError).  The timeout
+        applies while close() and get() wait for the process.  Resource
+        limits can be given in the limits argument as a dictionary of
+        names from LIMIT_RESOURCES and the soft limit on each, eg.
+        { "as": 1 << 30 } for a gigabyte of address space.  Either not
+        passed or None takes the value from DEFAULT_LIMITS for the
+        command, if there is one there.
         """
         self.args = list(args)
         self.okstatus = okstatus
 
+        defaults = DEFAULT_LIMITS.get(os.path.basename(self.args[0]), {})
+        if timeout is None:
+            timeout = defaults.get("timeout")
+        if limits is None:
+            limits = dict((name, value) for name, value in defaults.items()
+                          if name != "timeout")
+
+        self.timeout = timeout
+        self.limits = {}
+        for name, value in limits.items():
+            if name not in LIMIT_RESOURCES:
+                raise ValueError, "unknown resource limit: %s" % name
+            self.limits[LIMIT_RESOURCES[name]] = value
+
         # Sanity check mode
         self.mode = mode
         if not len(self.mode) or self.mode[0] not in "rwx":
@@ -109,6 +238,16 @@ class Process(object):
         else:
             self.env = dict(env)
 
+        self._spawn_error = None
+        self.context = get_context()
+        self.inherited_rss \
+            = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.started = time.time()
+        if self.timeout is not None:
+            self.deadline = self.started + self.timeout
+        else:
+            self.deadline = None
+
         self.open(stdin, stdout, stderr, chdir)
 
     def open(self, stdin, stdout, stderr, chdir):
@@ -116,13 +255,39 @@ class Process(object):
 
         This is called automatically by __init__ and is separated out to
         allow sub-classes to override __init__ or open as they see fit.
+
+        Where possible the process is started with posix_spawnp(3) by
+        spawn(), otherwise this forks and calls child().
         """
         if self.mode[0] != "x":
             (pipe_r, pipe_w) = os.pipe()
+
+            # Don't leak the pipe into children forked by other threads,
+            # they would hold it open and we'd never see end of file
+            for fd in (pipe_r, pipe_w):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
         else:
             (pipe_r, pipe_w) = (None, None)
 
-        self.pid = os.fork()
+        self.forked = not self.spawnable(chdir)
+        if not self.forked:
+            try:
+                self.pid = self.spawn(pipe_r, pipe_w, stdin, stdout, stderr,
+                                      chdir)
+            except OSError, e:
+                # Reported by close(), as for a forked child that can't exec
+                self.pid = None
+                self._spawn_error = e
+        else:
+            self.pid = os.fork()
+            if self.pid > 0 and self.deadline is not None:
+                # Also done by the child, whichever gets there first
+                try:
+                    os.setpgid(self.pid, self.pid)
+                except OSError:
+                    pass
+
         if self.pid == 0:
             try:
                 self.child(pipe_r, pipe_w, stdin, stdout, stderr, chdir)
@@ -132,7 +297,7 @@ class Process(object):
                 os._exit(251)
             os._exit(252)
 
-        elif self.pid > 0:
+        elif self.pid is None or self.pid > 0:
             # Parent
             if self.mode[0] == "r":
                 os.close(pipe_w)
@@ -146,6 +311,146 @@ class Process(object):
             # Failure
             raise OSError, "%s failed" % " ".join(self.args)
 
+    def spawnable(self, chdir):
+        """Can the process be started by spawn()?
+
+        That needs posix_spawnp(3) and, to change directory, glibc's
+        posix_spawn_file_actions_addchdir_np().  posix_spawnp searches
+        our own PATH, so a process given a different one is forked.
+        Limits are set just after the process is started with prlimit(2),
+        so that's needed for them.
+        """
+        if _posix_spawnp is None:
+            return False
+        elif len(self.limits) and _prlimit is None:
+            return False
+        elif chdir is not None \
+                 and _spawn_funcs["posix_spawn_file_actions_addchdir_np"] \
+                 is None:
+            return False
+        elif self.env is not None \
+                 and self.env.get("PATH") != os.environ.get("PATH"):
+            return False
+        else:
+            return True
+
+    def spawn(self, pipe_r, pipe_w, stdin, stdout, stderr, chdir):
+        """Start the child process without forking.
+
+        Called by open in place of forking and calling child.  The same
+        redirections, directory change and signal reset are given to
+        posix_spawnp(3) as a list of actions to carry out in the new
+        process before it executes the command; the C library starts it
+        with vfork() so there's no copying of our address space, however
+        large that has grown.
+
+        The process is put in its own process group if it has a timeout,
+        so it can be killed along with its children.  Resource limits are
+        set as soon as posix_spawnp returns, which glibc only does once
+        the command is executing, so very little can happen before them.
+
+        Returns the process id, or raises OSError if the process couldn't
+        be started, including when the command couldn't be executed.
+        """
+        actions = ctypes.create_string_buffer(SPAWN_FILE_ACTIONS_SIZE)
+        attr = ctypes.create_string_buffer(SPAWNATTR_SIZE)
+        sigdefault = ctypes.create_string_buffer(SIGSET_SIZE)
+
+        spawn_call("posix_spawn_file_actions_init", actions)
+        try:
+            spawn_call("posix_spawnattr_init", attr)
+            try:
+                # Same order as child(), so stderr=sys.stdout works
+                if stderr is not None:
+                    if stderr == sys.stdout:
+                        spawn_call("posix_spawn_file_actions_adddup2",
+                                   actions, sys.__stdout__.fileno(),
+                                   sys.__stderr__.fileno())
+                    elif stderr != sys.stderr:
+                        spawn_call("posix_spawn_file_actions_adddup2",
+                                   actions, stderr.fileno(),
+                                   sys.__stderr__.fileno())
+                else:
+                    spawn_call("posix_spawn_file_actions_addopen", actions,
+                               sys.__stderr__.fileno(), "/dev/null",
+                               os.O_WRONLY, 0)
+
+                if self.mode[0] == "r":
+                    spawn_call("posix_spawn_file_actions_adddup2", actions,
+                               pipe_w, sys.__stdout__.fileno())
+                elif stdout is not None:
+                    if stdout == sys.stderr:
+                        spawn_call("posix_spawn_file_actions_adddup2",
+                                   actions, sys.__stderr__.fileno(),
+                                   sys.__stdout__.fileno())
+                    elif stdout != sys.stdout:
+                        spawn_call("posix_spawn_file_actions_adddup2",
+                                   actions, stdout.fileno(),
+                                   sys.__stdout__.fileno())
+                else:
+                    spawn_call("posix_spawn_file_actions_addopen", actions,
+                               sys.__stdout__.fileno(), "/dev/null",
+                               os.O_WRONLY, 0)
+
+                if self.mode[0] == "w":
+                    spawn_call("posix_spawn_file_actions_adddup2", actions,
+                               pipe_r, sys.__stdin__.fileno())
+                elif stdin is not None:
+                    if stdin != sys.stdin:
+                        spawn_call("posix_spawn_file_actions_adddup2",
+                                   actions, stdin.fileno(),
+                                   sys.__stdin__.fileno())
+                else:
+                    spawn_call("posix_spawn_file_actions_addopen", actions,
+                               sys.__stdin__.fileno(), "/dev/null",
+                               os.O_RDONLY, 0)
+
+                # The pipe itself is close-on-exec, so needs no action
+
+                if chdir is not None:
+                    spawn_call("posix_spawn_file_actions_addchdir_np",
+                               actions, chdir)
+
+                # Python's default disposition of SIG_IGN for SIGPIPE is
+                # not safe for non-Python subprocesses.
+                spawn_call("sigemptyset", sigdefault)
+                spawn_call("sigaddset", sigdefault, signal.SIGPIPE)
+                spawn_call("posix_spawnattr_setsigdefault", attr, sigdefault)
+                flags = POSIX_SPAWN_SETSIGDEF
+
+                if self.deadline is not None:
+                    spawn_call("posix_spawnattr_setpgroup", attr, 0)
+                    flags |= POSIX_SPAWN_SETPGROUP
+
+                spawn_call("posix_spawnattr_setflags", attr, flags)
+
+                argv = (ctypes.c_char_p * (len(self.args) + 1))(*self.args)
+                if self.env is None:
+                    envp = ctypes.c_void_p.in_dll(_libc, "environ")
+                else:
+                    envp = (ctypes.c_char_p * (len(self.env) + 1))(
+                        *[ "%s=%s" % item for item in self.env.items() ])
+
+                pid = ctypes.c_int()
+                err = _posix_spawnp(ctypes.byref(pid), self.args[0], actions,
+                                    attr, argv, envp)
+                if err != 0:
+                    raise OSError(err, os.strerror(err))
+
+                for res, value in self.limits.items():
+                    limit = _rlimit()
+                    if _prlimit(pid.value, res, None, ctypes.byref(limit)):
+                        break
+                    limit.rlim_cur = min(value, limit.rlim_max)
+                    if _prlimit(pid.value, res, ctypes.byref(limit), None):
+                        break
+
+                return pid.value
+            finally:
+                spawn_call("posix_spawnattr_destroy", attr)
+        finally:
+            spawn_call("posix_spawn_file_actions_destroy", actions)
+
     def child(self, pipe_r, pipe_w, stdin, stdout, stderr, chdir):
         """Child process.
 
@@ -190,6 +495,15 @@ class Process(object):
         if chdir is not None:
             os.chdir(chdir)
 
+        if self.deadline is not None:
+            os.setpgid(0, 0)
+
+        for res, value in self.limits.items():
+            (soft, hard) = resource.getrlimit(res)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.setrlimit(res, (value, hard))
+
         # Python's default disposition of SIG_IGN for SIGPIPE is not safe
         # for non-Python subprocesses.
         signal.signal(signal.SIGPIPE, signal.SIG_DFL)
@@ -209,6 +523,9 @@ class Process(object):
 
         Returns the exit code of the process, to get non-zero you must
         have included the value you wanted in okstatus to init.
+
+        The resources used by the process are added to the usage figures,
+        see record_usage().
         """
         if self._pipe is not None:
             try:
@@ -217,8 +534,21 @@ class Process(object):
                 # ignore broken pipe
                 pass
 
-        (pid, status) = os.waitpid(self.pid, 0)
-        if not os.WIFEXITED(status):
+        if self.pid is None:
+            raise OSError, "exec error: %s: %s" \
+                  % (" ".join(self.args), self._spawn_error.strerror)
+
+        (status, rusage, expired) = self.wait()
+        record_usage(self.args[0], self.context, time.time() - self.started,
+                     rusage, self.inherited_rss)
+
+        if expired:
+            raise TimeoutExpired, "timed out after %s seconds: %s" \
+                  % (self.timeout, " ".join(self.args))
+        elif os.WIFSIGNALED(status):
+            raise OSError, "killed by signal %d: %s" \
+                  % (os.WTERMSIG(status), " ".join(self.args))
+        elif not os.WIFEXITED(status):
             raise OSError, "abnormal exit: %s" % " ".join(self.args)
         elif os.WEXITSTATUS(status) == 250:
             raise OSError, "exec error: %s" % " ".join(self.args)
@@ -232,6 +562,80 @@ class Process(object):
 
         return os.WEXITSTATUS(status)
 
+    def wait(self):
+        """Wait for the process to exit.
+
+        A process with a timeout is polled until it exits or its deadline
+        passes, when it's killed.  Returns the exit status and resource
+        usage, and whether the process was killed for taking too long.
+        """
+        if self.deadline is None:
+            (pid, status, rusage) = os.wait4(self.pid, 0)
+            return (status, rusage, False)
+
+        delay = WAIT_POLL_MIN
+        try:
+            while True:
+                (pid, status, rusage) = os.wait4(self.pid, os.WNOHANG)
+                if pid != 0:
+                    return (status, rusage, False)
+
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, WAIT_POLL_MAX)
+        except KeyboardInterrupt:
+            # Its group doesn't get the terminal's signal, don't leave it
+            self.kill()
+            os.wait4(self.pid, 0)
+            raise
+
+        self.kill()
+        (pid, status, rusage) = os.wait4(self.pid, 0)
+        return (status, rusage, True)
+
+    def kill(self, sig=signal.SIGKILL):
+        """Kill the process.
+
+        A process with a timeout is in its own process group, the whole
+        group is sent the signal.
+        """
+        try:
+            if self.deadline is not None:
+                os.killpg(self.pid, sig)
+            else:
+                os.kill(self.pid, sig)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def read_all(self):
+        """Read all of the output of a process opened for reading.
+
+        If the process has a timeout this stops waiting for output when
+        it passes, leaving close() to kill the process.
+        """
+        if self.deadline is None:
+            return self._pipe.read()
+
+        fd = self._pipe.fileno()
+        chunks = []
+        while True:
+            remaining = self.deadline - time.time()
+            if remaining <= 0 \
+                   or not len(select.select([ fd ], [], [], remaining)[0]):
+                break
+
+            chunk = os.read(fd, 65536)
+            if not len(chunk):
+                break
+
+            chunks.append(chunk)
+
+        return "".join(chunks)
+
     def __iter__(self):
         """Wraps the iterator of the pipe."""
         if self._pipe is not None:
@@ -249,18 +653,19 @@ class Process(object):
 
 
 def run(args, stdin=None, stdout=None, stderr=None, chdir=None, okstatus=(0,),
-        env=None):
+        env=None, timeout=None, limits=None):
     """Run a process without an input or output pipe.
 
     Shorthand for util.shell.Process(...) with mode fixed to 'x' and calls
     close immediately.
     """
     p = Process(args, "x", stdin=stdin, stdout=stdout, stderr=stderr,
-                chdir=chdir, okstatus=okstatus, env=env)
+                chdir=chdir, okstatus=okstatus, env=env, timeout=timeout,
+                limits=limits)
     return p.close()
 
 def get(args, stdin=None, stderr=None, chdir=None, okstatus=(0,), env=None,
-        strip=True):
+        strip=True, timeout=None, limits=None):
     """Get process output.
 
     Shorthand for util.shell.Process(...) with mode fixed to 'r' and
@@ -269,12 +674,272 @@ def get(args, stdin=None, stderr=None, chdir=None, okstatus=(0,), env=None,
     If strip is True (the default) any final newlines will be stripped.
     """
     p = Process(args, "r", stdin=stdin, stderr=stderr, chdir=chdir,
-                okstatus=okstatus, env=env)
+                okstatus=okstatus, env=env, timeout=timeout, limits=limits)
     try:
-        text = p.read()
+        text = p.read_all()
         if strip:
             return text.rstrip("\r\n")
         else:
             return text
     finally:
         p.close()
+
+
+def set_context(context):
+    """Set the context that usage of processes started from now by this
+    thread is recorded against, or None for none."""
+    USAGE_CONTEXT.context = context
+
+def get_context():
+    """Return the context set by this thread."""
+    return getattr(USAGE_CONTEXT, "context", None)
+
+def record_usage(command, context, wall, rusage, inherited_rss=None):
+    """Add the resources used by a child process to the usage figures.
+
+    Figures are kept for each command name and context: the number of
+    calls, wall clock time, user and system CPU time, the largest
+    maximum resident set size (in KiB) and the blocks read and written.
+
+    The kernel counts the image a child was started from, ours, in its
+    maximum resident set size; that's as true of a child spawned with
+    vfork() as one forked, since exec takes the peak of the image it
+    replaces.  So only a figure larger than inherited_rss, our own peak
+    when the child was started (or now, if not given), is known to be
+    the child's and anything else is recorded as zero.
+    """
+    key = (os.path.basename(command), context)
+    if inherited_rss is None:
+        inherited_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    maxrss = rusage.ru_maxrss
+    if maxrss <= inherited_rss:
+        maxrss = 0
+
+    with USAGE_LOCK:
+        usage = USAGE.setdefault(key, new_usage())
+        usage["calls"] += 1
+        usage["wall"] += wall
+        usage["utime"] += rusage.ru_utime
+        usage["stime"] += rusage.ru_stime
+        usage["maxrss"] = max(usage["maxrss"], maxrss)
+        usage["inblock"] += rusage.ru_inblock
+        usage["oublock"] += rusage.ru_oublock
+
+def new_usage():
+    """Return empty usage figures."""
+    return { "calls": 0, "wall": 0.0, "utime": 0.0, "stime": 0.0,
+             "maxrss": 0, "inblock": 0, "oublock": 0 }
+
+def add_usage(usage, other):
+    """Add one set of usage figures to another."""
+    for field, value in other.items():
+        if field == "maxrss":
+            usage[field] = max(usage[field], value)
+        else:
+            usage[field] += value
+
+def merge_usage(usages):
+    """Merge usage figures from another process into ours.
+
+    Takes a dictionary in the same form as USAGE, such as a copy returned
+    from a worker.
+    """
+    with USAGE_LOCK:
+        for key, usage in usages.items():
+            add_usage(USAGE.setdefault(key, new_usage()), usage)
+
+def reset_usage():
+    """Forget the usage figures recorded so far."""
+    with USAGE_LOCK:
+        USAGE.clear()
+
+def usage_totals(by):
+    """Return the usage figures totalled by command or context.
+
+    by is "command" or "context", returns a dictionary of the figures
+    for each; processes with no context aren't included in the totals
+    by context.
+    """
+    totals = {}
+    with USAGE_LOCK:
+        for (command, context), usage in USAGE.items():
+            if by == "command":
+                name = command
+            elif context is not None:
+                name = context
+            else:
+                continue
+
+            add_usage(totals.setdefault(name, new_usage()), usage)
+
+    return totals
+
+def spawn_call(name, *args):
+    """Call one of the posix_spawn support functions.
+
+    These return zero or, on failure, either an error number or -1 with
+    errno set; an OSError is raised for those.
+    """
+    err = _spawn_funcs[name](*args)
+    if err == -1:
+        err = ctypes.get_errno()
+    if err != 0:
+        raise OSError(err, os.strerror(err))
+
+
+class Job(object):
+    """Job submitted to a pool.
+
+    This class holds a function call that a Pool will make at some point,
+    and the outcome of it once it has been made; it's what other languages
+    would call a future.
+
+    | job = pool.run(('diff3', ...), stdout=output, okstatus=(0,1,2))
+    | ...
+    | status = job.result()
+    """
+
+    def __init__(self, func, args, kwds):
+        self.func = func
+        self.args = args
+        self.kwds = kwds
+        self.context = get_context()
+
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def execute(self):
+        """Make the function call and keep its outcome.
+
+        This is called by the pool, either in one of its threads or
+        immediately on submission if it only runs one job at a time.
+        Processes it starts are recorded against the context of the
+        thread that submitted it.
+        """
+        set_context(self.context)
+        try:
+            self._result = self.func(*self.args, **self.kwds)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def done(self):
+        """Return whether the job has finished."""
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the job to finish and return its result.
+
+        If the function raised an exception it's raised again here, with
+        the original traceback, so a job submitted with run() or get()
+        raises OSError or ValueError exactly as the plain call would have
+        done when the process can't be executed or its exit status isn't
+        in okstatus.
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+
+class Pool(object):
+    """Pool of jobs.
+
+    This class runs function calls, normally ones that spawn and wait
+    for child processes, on a bounded number of threads so that several
+    of those processes run at once.  Each submission returns a Job from
+    which the result is later collected.
+
+    | pool = Pool(4)
+    | jobs = [ pool.run(('gzip', f)) for f in filenames ]
+    | for job in jobs:
+    |     job.result()
+    | pool.close()
+
+    The pool may also be used in a with statement, which closes it at
+    the end of the block.
+    """
+
+    def __init__(self, jobs=None):
+        """Create a pool.
+
+        Up to jobs calls are made at once, if not given or None this is
+        the number of CPUs.  With one job (or fewer) there are no threads
+        at all and each call is made immediately on submission, so the
+        work happens in the same order and thread as if the pool wasn't
+        there.
+        """
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+
+        self.jobs = jobs
+        self._queue = Queue()
+        self._threads = []
+
+    def submit(self, func, *args, **kwds):
+        """Submit a function call to the pool.
+
+        Returns a Job for the call.
+        """
+        job = Job(func, args, kwds)
+        if self.jobs <= 1:
+            job.execute()
+            return job
+
+        # Threads are only started as they are needed
+        if len(self._threads) < self.jobs:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self._queue.put(job)
+        return job
+
+    def run(self, args, **kwds):
+        """Run a process in the pool.
+
+        Takes the same arguments as util.shell.run, the job's result is
+        the exit status of the process.
+        """
+        return self.submit(run, args, **kwds)
+
+    def get(self, args, **kwds):
+        """Get process output in the pool.
+
+        Takes the same arguments as util.shell.get, the job's result is
+        the output of the process.
+        """
+        return self.submit(get, args, **kwds)
+
+    def close(self):
+        """Close the pool.
+
+        Waits for all submitted jobs to finish and the threads to exit,
+        the results of the jobs remain available afterwards.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def _worker(self):
+        """Thread to make function calls."""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            job.execute()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
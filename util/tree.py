@@ -18,8 +18,52 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import stat
 import shutil
 import errno
+import ctypes
+import ctypes.util
+
+from util import shell
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+# FICLONE ioctl from <linux/fs.h>, shares a file's extents with another
+FICLONE = 0x40049409
+
+# Largest number of bytes to ask the kernel to copy in one call
+COPY_CHUNK_SIZE = 1 << 30
+
+# Errors meaning a copy method isn't supported for these files
+COPY_UNSUPPORTED = ( errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV,
+                     errno.EINVAL, errno.ENOTTY, errno.EPERM )
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except OSError:
+    _libc = None
+
+_ioctl = getattr(_libc, "ioctl", None)
+if _ioctl is not None:
+    _ioctl.argtypes = ( ctypes.c_int, ctypes.c_ulong, ctypes.c_int )
+    _ioctl.restype = ctypes.c_int
+
+_copy_file_range = getattr(_libc, "copy_file_range", None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = ( ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_size_t, ctypes.c_uint )
+    _copy_file_range.restype = ctypes.c_ssize_t
+
+_sendfile = getattr(_libc, "sendfile", None)
+if _sendfile is not None:
+    _sendfile.argtypes = ( ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                           ctypes.c_size_t )
+    _sendfile.restype = ctypes.c_ssize_t
 
 
 def as_dir(path):
@@ -92,17 +136,168 @@ def walk(path, topdown=True, relative=True):
         if not topdown:
             yield base
 
-def copytree(path, newpath, link=False, dereference=False):
+def size(path, shared=True):
+    """Return the total size of the files in a tree.
+
+    A file with several hardlinks in the tree is counted once.  If shared
+    is False, files that also have links outside the tree aren't counted
+    at all, on the basis that they're accounted for wherever else they
+    are.
+    """
+    total = 0
+    linked = {}
+    for filename, st in walk_stat(path):
+        if stat.S_ISDIR(st.st_mode) or st.st_nlink == 1:
+            total += st.st_size
+        else:
+            key = (st.st_dev, st.st_ino)
+            (links, st) = linked.get(key, (0, st))
+            linked[key] = (links + 1, st)
+
+    for links, st in linked.values():
+        if shared or links >= st.st_nlink:
+            total += st.st_size
+
+    return total
+
+def walk_stat(path, topdown=True):
+    """Returns an iterator to walk over a tree with stat results.
+
+    Like walk(), but yields the relative path to each entry along with
+    its lstat result, which is read as the directory is listed so there
+    is no need to stat it again.  Symbolic links, including those to
+    directories, are not followed.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+
+    if stat.S_ISDIR(st.st_mode):
+        for entry in _walk_stat(path, "", st, topdown):
+            yield entry
+
+def _walk_stat(path, base, st, topdown):
+    """Walk one directory for walk_stat()."""
+    if topdown:
+        yield (base, st)
+
+    try:
+        entries = listdir_stat(os.path.join(path, base))
+    except OSError:
+        # Unreadable, as os.walk we carry on without it
+        entries = []
+
+    for name, entry_st in entries:
+        filename = os.path.join(base, name)
+        if stat.S_ISDIR(entry_st.st_mode):
+            for entry in _walk_stat(path, filename, entry_st, topdown):
+                yield entry
+        else:
+            yield (filename, entry_st)
+
+    if not topdown:
+        yield (base, st)
+
+def listdir_stat(path):
+    """Return the names and lstat results of the entries in a directory."""
+    if scandir is not None:
+        return [ (entry.name, entry.stat(follow_symlinks=False))
+                 for entry in scandir(path) ]
+    else:
+        return [ (name, os.lstat(os.path.join(path, name)))
+                 for name in os.listdir(path) ]
+
+def scan(path):
+    """Returns an iterator over the contents of a tree.
+
+    Yields the relative path and type of everything within the tree, a
+    directory always coming before its contents.  The type is one of
+    "dir", "link", "file" or "other"; symbolic links are not followed.
+    """
+    pending = [ "" ]
+    while len(pending):
+        base = pending.pop()
+        for name, kind in listdir_types(os.path.join(path, base)):
+            filename = os.path.join(base, name)
+            yield (filename, kind)
+
+            if kind == "dir":
+                pending.append(filename)
+
+def listdir_types(path):
+    """Return the names and types of the entries in a directory."""
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_symlink():
+                kind = "link"
+            elif entry.is_dir(follow_symlinks=False):
+                kind = "dir"
+            elif entry.is_file(follow_symlinks=False):
+                kind = "file"
+            else:
+                kind = "other"
+            entries.append((entry.name, kind))
+    else:
+        for name in os.listdir(path):
+            mode = os.lstat(os.path.join(path, name)).st_mode
+            if stat.S_ISLNK(mode):
+                kind = "link"
+            elif stat.S_ISDIR(mode):
+                kind = "dir"
+            elif stat.S_ISREG(mode):
+                kind = "file"
+            else:
+                kind = "other"
+            entries.append((name, kind))
+
+    return entries
+
+def copytree(path, newpath, link=False, dereference=False, jobs=None):
     """Create a copy of the tree at path under newpath.
 
     Copies a directory tree from one location to another, or if link is
-    True the copy is hardlinked to the original.  Symbolic links are
-    preserved unless dereference is True.  All other permissions are
-    retained.
+    True the copy is hardlinked to the original where the filesystem
+    allows it.  Symbolic links are preserved unless dereference is True.
+    All other permissions are retained.
+
+    If jobs is given, the contents of up to that many files are copied
+    at once on a util.shell.Pool.
     """
-    for filename in walk(path):
-        copyfile(os.path.join(path, filename), os.path.join(newpath, filename),
-                 link=link, dereference=dereference)
+    if exists(newpath):
+        # Copy over the top of the existing tree, replacing what's there
+        for filename in walk(path):
+            copyfile(os.path.join(path, filename),
+                     os.path.join(newpath, filename),
+                     link=link, dereference=dereference)
+        return
+
+    os.makedirs(newpath)
+
+    # Directories are made before anything is copied into them, as scan()
+    # lists a directory before its contents
+    copies = []
+    with shell.Pool(jobs or 1) as pool:
+        for filename, kind in scan(path):
+            srcpath = os.path.join(path, filename)
+            dstpath = os.path.join(newpath, filename)
+
+            if kind == "dir":
+                os.mkdir(dstpath)
+            elif kind == "link" and not dereference:
+                os.symlink(os.readlink(srcpath), dstpath)
+            elif kind == "link" and os.path.isdir(srcpath):
+                # Not descended into, as with walk()
+                os.mkdir(dstpath)
+            elif kind == "other" or link:
+                copyfile(srcpath, dstpath, link=link,
+                         dereference=dereference)
+            else:
+                copies.append(pool.submit(copy2, srcpath, dstpath))
+
+        for copy in copies:
+            copy.result()
 
 def copyfile(srcpath, dstpath, link=False, dereference=False):
     """Copy a file from one path to another.
@@ -127,9 +322,77 @@ def copyfile(srcpath, dstpath, link=False, dereference=False):
     elif os.path.isdir(srcpath):
         os.makedirs(dstpath)
     elif link:
-        os.link(srcpath, dstpath)
+        try:
+            os.link(srcpath, dstpath)
+        except OSError, e:
+            # Different filesystem, no hardlink support or too many links
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            copy2(srcpath, dstpath)
     else:
-        shutil.copy2(srcpath, dstpath)
+        copy2(srcpath, dstpath)
+
+def copy2(srcpath, dstpath):
+    """Copy a file's contents, permissions and times.
+
+    As shutil.copy2, but the contents are copied with copydata().
+    """
+    copydata(srcpath, dstpath)
+    shutil.copystat(srcpath, dstpath)
+
+def copydata(srcpath, dstpath):
+    """Copy the contents of one file to another.
+
+    Tries cloning the file on filesystems that can share extents, then
+    copy_file_range and sendfile which copy without the data passing
+    through this process, and finally an ordinary read and write.
+
+    Raises shutil.SpecialFileError, as shutil.copyfile does, if srcpath
+    is a named pipe, socket or device rather than a regular file.
+    """
+    if not stat.S_ISREG(os.stat(srcpath).st_mode):
+        raise shutil.SpecialFileError, "`%s' is not a regular file" % srcpath
+
+    with open(srcpath, "rb") as src:
+        with open(dstpath, "wb") as dst:
+            (src_fd, dst_fd) = (src.fileno(), dst.fileno())
+            size = os.fstat(src_fd).st_size
+
+            if _ioctl is not None and _ioctl(dst_fd, FICLONE, src_fd) == 0:
+                return
+
+            if _copy_file_range is not None \
+                   and kernel_copy(size, lambda: _copy_file_range(
+                       src_fd, None, dst_fd, None, COPY_CHUNK_SIZE, 0)):
+                return
+
+            if _sendfile is not None \
+                   and kernel_copy(size, lambda: _sendfile(
+                       dst_fd, src_fd, None, COPY_CHUNK_SIZE)):
+                return
+
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+def kernel_copy(size, copy_func):
+    """Copy a file with a kernel copy call.
+
+    Calls copy_func until it reports the end of the file, returning
+    False if it fails before copying anything, in which case another
+    way should be used; errors after that are raised.
+    """
+    copied = 0
+    while True:
+        count = copy_func()
+        if count < 0:
+            err = ctypes.get_errno()
+            if copied == 0 and err in COPY_UNSUPPORTED:
+                return False
+            raise OSError, (err, os.strerror(err))
+        elif count == 0:
+            # Some filesystems report an empty file rather than failing
+            return copied == size
+
+        copied += count
 
 def movetree(path, newpath, eat_toplevel=False):
     """Move the contents of one tree into another.
@@ -164,17 +427,12 @@ def rmtree(path):
     to call this function if you don't know whether the destination exists
     or not.
     """
-    if not exists(path):
-        return
-
-    for filename in walk(path, topdown=False, relative=False):
+    for filename, st in walk_stat(path, topdown=False):
         try:
-            if os.path.islink(filename):
-                os.unlink(filename)
-            elif os.path.isdir(filename):
-                os.rmdir(filename)
+            if stat.S_ISDIR(st.st_mode):
+                os.rmdir(os.path.join(path, filename))
             else:
-                os.unlink(filename)
+                os.unlink(os.path.join(path, filename))
         except OSError, e:
             if e.errno != errno.ENOENT:
                 raise